@@ -15,6 +15,8 @@ from gym.vector.utils import (create_shared_memory, create_empty_array,
                               write_to_shared_memory, read_from_shared_memory,
                               concatenate, CloudpickleWrapper, clear_mpi_env_vars)
 
+from app.utils.video import rgb_to_yuv420p
+
 __all__ = ['AsyncVectorEnv']
 
 
@@ -296,12 +298,12 @@ class AsyncVectorEnv(VectorEnv):
 
         self.closed = True
 
-    def _poll(self, timeout=None):
+    def _poll(self, timeout=None, pipes=None):
         self._assert_is_running()
         if timeout is not None:
             end_time = time.time() + timeout
         delta = None
-        for pipe in self.parent_pipes:
+        for pipe in (self.parent_pipes if pipes is None else pipes):
             if timeout is not None:
                 delta = max(end_time - time.time(), 0)
             if pipe.closed or (not pipe.poll(delta)):
@@ -351,9 +353,11 @@ class AsyncVectorEnv(VectorEnv):
         pipe.send(("get_single_visuals", robot_idx))
         return pipe.recv()
 
-
     # Robohive Multi Visuals (All in One)
-    def get_visuals_async(self):
+    # sub_env_indices: only query the visuals of these sub envs (e.g. cameras someone is watching)
+    # resolutions: {sub_env_idx: "WxH"} to render the cameras of these sub envs at another resolution
+    # pixel_format: "yuv420p" to convert the camera images in the workers, for the video encoders
+    def get_visuals_async(self, sub_env_indices=None, resolutions=None, pixel_format=None):
         self._assert_is_running()
         # TODO: wait call seems to cause some trouble, although it should not.
         # More investigation needed ? Or make it purely async ?
@@ -361,9 +365,13 @@ class AsyncVectorEnv(VectorEnv):
         #     raise AlreadyPendingCallError('Calling `get_visuals_async` while waiting '
         #         'for a pending call to `{0}` to complete'.format(
         #         self._state.value), self._state.value)
-        
-        for pipe in self.parent_pipes:
-            pipe.send(('visuals', None))
+
+        if sub_env_indices is None:
+            sub_env_indices = range(self.num_envs)
+        self._visuals_sub_env_indices = sorted(sub_env_indices)
+        resolutions = resolutions or {}
+        for sub_env_idx in self._visuals_sub_env_indices:
+            self.parent_pipes[sub_env_idx].send(('visuals', (resolutions.get(sub_env_idx), pixel_format)))
         self._state = AsyncState.WAITING_VISUALS
 
     def get_visuals_wait(self, timeout=None):
@@ -372,16 +380,22 @@ class AsyncVectorEnv(VectorEnv):
             raise NoAsyncCallError('Calling `get_visuals_wait` without any prior '
                 'call to `get_visuals_async`.', AsyncState.WAITING_VISUALS.value)
 
-        if not self._poll(timeout):
+        pipes = [self.parent_pipes[sub_env_idx] for sub_env_idx in self._visuals_sub_env_indices]
+        if not self._poll(timeout, pipes):
             self._state = AsyncState.DEFAULT
             raise mp.TimeoutError('The call to `get_visuals_wait` has timed out after '
                 '{0} second{1}.'.format(timeout, 's' if timeout > 1 else ''))
 
         self._raise_if_errors()
         visuals = {}
-        global_robot_idx = 0 # track current agent idx from POV of desired total num_agents.
-        for sub_env_idx, pipe in enumerate(self.parent_pipes):
+        max_agents_per_env = getattr(self, "max_agents_per_env", 1)
+        for sub_env_idx, pipe in zip(self._visuals_sub_env_indices, pipes):
             sub_env_visual_dict = pipe.recv()
+            # track current agent idx from POV of desired total num_agents.
+            global_robot_idx = sub_env_idx * max_agents_per_env
+            if "time" in sub_env_visual_dict:
+                # simulation time of the frames; sub envs are stepped together
+                visuals.setdefault("time", sub_env_visual_dict["time"])
             for visual_key, visual_data in sub_env_visual_dict.items():
                 if not visual_key.startswith("rgb:franka"): # skip "time" mainly
                     continue
@@ -399,8 +413,8 @@ class AsyncVectorEnv(VectorEnv):
 
         return visuals
 
-    def get_visuals(self):
-        self.get_visuals_async()
+    def get_visuals(self, sub_env_indices=None, resolutions=None, pixel_format=None):
+        self.get_visuals_async(sub_env_indices, resolutions, pixel_format)
         return self.get_visuals_wait()
 
     # Robohive Multi Robot Status LED
@@ -614,6 +628,24 @@ class AsyncVectorEnv(VectorEnv):
         return self.get_policy_action_then_step_wait()
 
 
+def _get_visuals(env, resolution=None, pixel_format=None):
+    # resolution: "WxH" to render the cameras at, instead of the one in the env's visual keys
+    if resolution is None:
+        visuals = env.get_visuals()
+    else:
+        visual_keys = []
+        for key in env.visual_keys:
+            if key.startswith("rgb:"):
+                _, cam, _, dims = key.split(":")
+                key = f"rgb:{cam}:{resolution}:{dims}"
+            visual_keys.append(key)
+        visuals = env.get_visuals(visual_keys=visual_keys)
+    # pixel_format: convert here so that the main process does no colorspace conversion
+    if pixel_format == "yuv420p":
+        visuals = {key: rgb_to_yuv420p(data) if key.startswith("rgb:") else data for key, data in visuals.items()}
+    return visuals
+
+
 # Overriding to add support for custom sub env function handling
 def _worker(index, env_fn, pipe, parent_pipe, shared_memory, error_queue):
   assert shared_memory is None
@@ -631,7 +663,8 @@ def _worker(index, env_fn, pipe, parent_pipe, shared_memory, error_queue):
             observation = env.reset()
         pipe.send((observation, reward, done, info))
       elif command == "visuals":
-        pipe.send(env.get_visuals())
+        # data: (resolution or None, pixel_format or None)
+        pipe.send(_get_visuals(env, *data))
       elif command == "visual":
         # TODO: do we need a "visual_X" for each sub envs's robot ?
         raise NotImplementedError("Async query of sub envs visual not implemented yet !")
@@ -698,7 +731,8 @@ def _worker_shared_memory(index, env_fn, pipe, parent_pipe, shared_memory, error
                                 observation_space)
         pipe.send((None, reward, done, info))
       elif command == "visuals":
-        pipe.send(env.get_visuals())
+        # data: (resolution or None, pixel_format or None)
+        pipe.send(_get_visuals(env, *data))
       elif command == "visual":
         # TODO: do we need a "visual_X" for each sub envs's robot ?
         raise NotImplementedError("Async query of sub envs visual not implemented yet !")
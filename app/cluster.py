@@ -0,0 +1,204 @@
+"""Run the server as several processes on one machine.
+
+Each worker process is a full `app.main` server listening on its own port (base port + worker index).
+Every mode is owned by one worker so that its EnvRunners, streams and viewers stay in the same process;
+the other workers redirect the task page of the mode to it (see `worker_for_mode`). As the task page is the
+only one opening a socket, every socket.io client is connected to the worker whose events it receives.
+
+The workers share a broker process listening on a Unix socket, which keeps the session state that must be
+consistent across workers, e.g. the usernames in use (see `SharedStore`).
+
+Usage:
+    python -m app.cluster -n 3
+"""
+
+import asyncio
+import json
+import os
+import secrets
+import shutil
+import signal
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Optional
+
+import click
+from dotenv import load_dotenv
+
+env_file = Path(__file__).parent / ".env"
+
+
+def get_worker_index() -> Optional[int]:
+    """Index of this process in the cluster, or None if the server runs as a single process."""
+    index = os.getenv("CLUSTER_WORKER")
+    return int(index) if index is not None else None
+
+
+def get_num_workers() -> int:
+    return int(os.getenv("CLUSTER_SIZE", 1))
+
+
+def get_session_secret_key() -> str:
+    """Key signing the session cookies, generated and saved to app/.env on first use."""
+    secret_key = os.getenv("SESSION_SECRET_KEY")
+    if secret_key is None:
+        secret_key = secrets.token_urlsafe(32)
+        with open(env_file, "a") as f:
+            f.write(f"SESSION_SECRET_KEY={secret_key}\n")
+    return secret_key
+
+
+def worker_for_mode(mode: str, modes: list, num_workers: int) -> int:
+    # modes are spread in the order of `modes` (i.e. env_info) so that the assignment is stable
+    return modes.index(mode) % num_workers
+
+
+# framing: 4-byte length + JSON message; the socket is only accessible to the user running the cluster
+
+
+async def _send(writer: asyncio.StreamWriter, message):
+    data = json.dumps(message).encode()
+    writer.write(struct.pack("!I", len(data)) + data)
+    await writer.drain()
+
+
+async def _recv(reader: asyncio.StreamReader):
+    size = struct.unpack("!I", await reader.readexactly(4))[0]
+    return json.loads(await reader.readexactly(size))
+
+
+class Broker:
+    """Key-value store shared by the workers."""
+
+    def __init__(self, socket_path: str):
+        self.socket_path = socket_path
+        self.store = {}
+
+    async def serve(self):
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        os.umask(0o177)  # the socket is created with mode 0600
+        server = await asyncio.start_unix_server(self._handle, path=self.socket_path)
+        print(f"Broker listening on {self.socket_path}")
+        async with server:
+            await server.serve_forever()
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                op, *args = await _recv(reader)
+                if op == "get":
+                    await _send(writer, self.store.get(args[0]))
+                elif op == "set":
+                    self.store[args[0]] = args[1]
+                elif op == "del":
+                    self.store.pop(args[0], None)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+class SharedStore:
+    """Client of the broker's key-value store. Without a broker, values are kept in this process."""
+
+    def __init__(self, socket_path: Optional[str] = None):
+        self.socket_path = socket_path
+        self.local = {}
+        self._connection = None
+        self._lock = asyncio.Lock()  # one request at a time on the connection
+
+    async def _request(self, message, has_reply: bool = False):
+        async with self._lock:
+            if self._connection is None:
+                self._connection = await asyncio.open_unix_connection(self.socket_path)
+            reader, writer = self._connection
+            try:
+                await _send(writer, message)
+                if has_reply:
+                    return await _recv(reader)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                # e.g. the broker restarted; the next request reconnects
+                self._connection = None
+                writer.close()
+                raise
+
+    async def get(self, key):
+        if self.socket_path is None:
+            return self.local.get(key)
+        return await self._request(("get", key), has_reply=True)
+
+    async def set(self, key, value):
+        if self.socket_path is None:
+            self.local[key] = value
+            return
+        await self._request(("set", key, value))
+
+    async def delete(self, key):
+        if self.socket_path is None:
+            self.local.pop(key, None)
+            return
+        await self._request(("del", key))
+
+
+@click.command()
+@click.option("-n", "--num-workers", default=2, help="Number of server processes")
+@click.option("-p", "--port", default=8000, help="Port of the first worker; worker i listens on port + i")
+@click.option("--socket-path", default=None, help="Unix socket of the broker; by default in a private temp dir")
+def main(num_workers, port, socket_path):
+    # the workers must sign the session cookies with the same key, so it is set up before they start
+    load_dotenv(env_file)
+    secret_key = get_session_secret_key()
+
+    socket_dir = None
+    if socket_path is None:
+        socket_dir = tempfile.mkdtemp(prefix="multiagent-bmi-cluster-")  # mode 0700
+        socket_path = os.path.join(socket_dir, "broker.sock")
+    elif os.path.exists(socket_path):
+        os.remove(socket_path)  # left by a previous run; the workers must wait for the new broker
+    broker = subprocess.Popen([sys.executable, "-m", "app.cluster", "broker", socket_path])
+    while not os.path.exists(socket_path) and broker.poll() is None:
+        time.sleep(0.1)
+
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+    workers = []
+    for i in range(num_workers):
+        env = dict(
+            os.environ,
+            CLUSTER_WORKER=str(i),
+            CLUSTER_SIZE=str(num_workers),
+            CLUSTER_SOCKET=socket_path,
+            CLUSTER_BASE_PORT=str(port),
+            PORT=str(port + i),
+            SESSION_SECRET_KEY=secret_key,
+        )
+        # share the cores between the env instances of all workers
+        env.setdefault("MAX_ENV_WORKERS", str(max(1, cores // num_workers)))
+        workers.append(subprocess.Popen([sys.executable, "-m", "app.main"], env=env))
+        print(f"Worker {i} started on port {port + i}")
+
+    def stop(*args):
+        for process in workers + [broker]:
+            process.terminate()
+
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        for process in workers:
+            process.wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop()
+        if socket_dir is not None:
+            shutil.rmtree(socket_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == "broker":
+        asyncio.run(Broker(sys.argv[2]).serve())
+    else:
+        main()
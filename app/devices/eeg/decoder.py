@@ -8,6 +8,7 @@ from typing import Union, Tuple
 
 from app.devices.utils.networking import extract_buffer
 from app.devices.utils.utils import array2str
+from app.utils.wire import encode_event
 
 
 class Decoder:
@@ -29,9 +30,11 @@ class Decoder:
         self.window_step = window_step
         self.loop = asyncio.get_event_loop()
         self.sio: socketio.AsyncServer | None = None
+        self.wire_format = "json"  # encoding of the likelihoods, requested by the browser (see app/utils/wire.py)
 
-    def set_socket(self, sio: socketio.AsyncServer) -> None:
+    def set_socket(self, sio: socketio.AsyncServer, wire_format: str = "json") -> None:
         self.sio = sio
+        self.wire_format = wire_format
 
     def start(self) -> None:
         if self.is_running:
@@ -64,7 +67,8 @@ class Decoder:
 
     async def _emit(self, class_id: Union[int, None], likelihoods: np.ndarray) -> None:
             assert isinstance(self.sio, socketio.AsyncServer), "Socket is not set."
-            await self.sio.emit("eeg", {"classId": class_id, "likelihoods": likelihoods.tolist()})
+            data = {"classId": class_id, "likelihoods": likelihoods.tolist()}
+            await self.sio.emit("eeg", encode_event("eeg", data, self.wire_format))
 
     def stop(self) -> None:
         if self.subscription is not None:
@@ -132,9 +132,14 @@ def main(
         user_id = data["userId"]
         exp_id = data["expId"]
 
+        wire_format = data.get("wireFormat", "json")
+
         if len(runners) > 0:
             # if the runners are already set up, do nothing
             print("Runners are already set up. Use the existing runners.")
+            for runner in runners:
+                if isinstance(runner, Decoder):
+                    runner.wire_format = wire_format
             return
 
         # Create stream inlets
@@ -204,7 +209,7 @@ def main(
             # window_step = window_size // 2
             window_step = None  # no overlap
             decoder = Decoder(input_observable, model, window_size, window_step)
-            decoder.set_socket(sio)
+            decoder.set_socket(sio, wire_format)
             decoder.start()
             runners.append(decoder)
 
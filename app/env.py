@@ -2,26 +2,52 @@ import asyncio
 import multiprocessing as mp
 import os
 import platform
+import re
 import subprocess
 import time
+from functools import lru_cache, partial
+from pathlib import Path
 
-import gym
-import robohive_multi  # Makes the environments accessible # noqa: F401 # type: ignore
-from app.async_vector_env import AsyncVectorEnv
+import numpy as np
+from app.utils import telemetry
+from app.utils.video import rgb_to_yuv420p
 
-# check if display is available on Linux
-if platform.system() == "Linux":
+# NOTE: gym and robohive_multi are imported when the first simulated env is created (see
+# MultiRobotSubEnvWrapper), so that the server starts without loading the simulation stack.
+
+
+@lru_cache(maxsize=None)
+def configure_gl():
+    """Choose the MuJoCo rendering backend once, before the simulation is imported.
+
+    The choice is kept in MUJOCO_GL, so the env worker processes inherit it without probing again.
+    """
+    if "MUJOCO_GL" in os.environ or platform.system() != "Linux":
+        return
+    # check if display is available
     print("Checking display...")
     try:
+        if "DISPLAY" not in os.environ:
+            raise FileNotFoundError
         subprocess.run(["xdpyinfo"], check=True, timeout=1, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
         print("Display is available")
-    except (subprocess.CalledProcessError, subprocess.TimeoutExpired):
+        os.environ["MUJOCO_GL"] = "glfw"  # the default of MuJoCo
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired, FileNotFoundError):
+        # NOTE: rendering is slow without GPU
         print("Display is not available, using egl rendering")
         os.environ["MUJOCO_GL"] = "egl"
 
-# NOTE: rendering is slow without GPU
+
+def _make_sub_env(name: str):
+    # runs in the env worker processes (and once in the server for the spaces of AsyncVectorEnv)
+    import gym
+    import robohive_multi  # Makes the environments accessible # noqa: F401 # type: ignore
+
+    return gym.make(name)
+
 
 dt_step = 0.03
+cache_dir = Path(__file__).parent / "cache"  # prerendered frames
 
 
 class EnvRunner:
@@ -38,15 +64,27 @@ class EnvRunner:
         # callbacks
         self.notify_fn = notify_fn
         self.on_completed_fn = on_completed_fn
+        self._init_telemetry(env_id)
 
         self.env = MultiRobotSubEnvWrapper(num_agents=num_agents, max_agents_per_env=min(num_agents, 1))
 
         self.num_agents = num_agents
         self.a_dim_per_agent = self.env.sub_envs.single_action_space.shape[0] // self.env.max_agents_per_env
+        self._init_commands(use_cancel_command)
+
+        # init policies
+        horizon = 2  # TODO
+        # Motion Planner Policies are setup within the env itself, parallelization
+        self.env.setup_motion_planner_policies(horizon=horizon)
 
-        # self.env.color_dict: {"100": 0, "010": 1, ...}
+        # reset env for rendering
+        self._reset_env()
+
+    def _init_commands(self, use_cancel_command):
+        """Set up the commands and the command states of the `num_agents` agents (also without simulation)."""
+        # MultiRobotSubEnvWrapper.color_dict: {"100": 0, "010": 1, ...}
         # key digits correspond to "rgb", values correspond to the rgb index in Mujoco?
-        self.command_colors = list(self.env.color_dict.keys())
+        self.command_colors = list(MultiRobotSubEnvWrapper.color_dict.keys())
         self.num_subtasks = len(self.command_colors)
         self.command_labels = [f"color{i + 1}" for i in range(len(self.command_colors))]  # TODO: more meaningful names?
         if use_cancel_command:
@@ -61,15 +99,18 @@ class EnvRunner:
         self.next_acceptable_commands: list[list[str]] = list(
             map(self._get_next_acceptable_commands, self.command)
         )  # next acceptable commands for each agent
-
-        # init policies
-        horizon = 2  # TODO
-        # Motion Planner Policies are setup within the env itself, parallelization
-        self.env.setup_motion_planner_policies(horizon=horizon)
         self.policies_done_subtasks = [[] for i in range(self.num_agents)] # Tracking progression of each robot
 
-        # reset env for rendering
-        self._reset_env()
+    def _init_telemetry(self, env_id):
+        # metrics with bound labels, updated at every step
+        self.tick_period_metric = telemetry.env_tick_period.labels(env_id)
+        self.tick_overruns_metric = telemetry.env_tick_overruns.labels(env_id)
+        self.last_tick_time = None
+
+    def _observe_tick(self, tick_start):
+        if self.last_tick_time is not None:
+            self.tick_period_metric.observe(tick_start - self.last_tick_time)
+        self.last_tick_time = tick_start
 
     def _get_next_acceptable_commands(self, current_command):
         """Return next acceptable commands for the given command."""
@@ -126,7 +167,10 @@ class EnvRunner:
         env = self.env
         obs = init_obs
 
+        self.last_tick_time = None
         while self.is_running:
+            tick_start = time.perf_counter()
+            self._observe_tick(tick_start)
             # Inefficient: query all sub env's motion planner, pool the actions and subtask_dones
             # then send the action down to each sub-envs again to perform an env.step()
             # action, subtask_dones = self.env.sub_envs.get_policy_action(obs, self.command, norm=False)
@@ -138,6 +182,7 @@ class EnvRunner:
             # motion planner action is computed and used to step directly.
             # Assumes X envs * 1 robot per env config. of the sub-envs.
             subtask_dones = env.sub_envs.get_policy_action_then_step(obs, self.command, norm=False)
+            telemetry.env_worker_roundtrip.labels("step").observe(time.perf_counter() - tick_start)
 
             # check if subtask is done
             if any(subtask_dones):
@@ -165,6 +210,8 @@ class EnvRunner:
                 if self.on_completed_fn is not None:
                     self.on_completed_fn()
 
+            if time.perf_counter() - tick_start > dt_step:
+                self.tick_overruns_metric.inc()
             await asyncio.sleep(dt_step)
 
     async def update_and_notify_command(self, command, agent_id, username=None, likelihoods=None, interaction_time=None):
@@ -204,6 +251,158 @@ class EnvRunner:
         return data
 
 
+class PrerenderedEnvRunner(EnvRunner):
+    """EnvRunner without simulation, serving cached frames of the initial scene.
+
+    Used for data collection, where the scene stays still and no command is sent to the robots.
+    The frames are rendered once and cached in `cache_dir`; a cached clip (several frames) is looped.
+    Like MultiRobotSubEnvWrapper.get_visuals, the frames are served as yuv420p.
+    """
+
+    def __init__(
+        self,
+        env_id: str,
+        num_agents: int,
+        notify_fn=None,
+        on_completed_fn=None,
+        use_cancel_command: bool = False,
+    ) -> None:
+        self.is_running = False
+
+        # callbacks
+        self.notify_fn = notify_fn
+        self.on_completed_fn = on_completed_fn
+
+        self.env = self  # provides get_visuals like MultiRobotSubEnvWrapper
+        self.frames = load_prerendered_frames(env_id, num_agents)
+
+        self.num_agents = num_agents
+        self._init_commands(use_cancel_command)
+
+    def _reset_env(self):
+        return None
+
+    def start(self):
+        self.is_running = True
+        print("prerendered env started")
+
+    async def stop(self):
+        self.is_running = False
+        await self.reset()
+
+    async def get_visuals(self, keys=None, resolutions=None):
+        # loop over the cached clip, assuming it was recorded at every env step
+        t = int(time.time() / dt_step)
+        return {key: frames[t % len(frames)] for key, frames in self.frames.items() if keys is None or key in keys}
+
+
+class BenchmarkEnvRunner(EnvRunner):
+    """EnvRunner without simulation for load tests (see app/scripts/load_test.py).
+
+    Robots complete a subtask `subtask_sec` after receiving its command, and the cameras show
+    synthetic moving frames. The task never completes so that a load test is not cut short:
+    once a robot has done all its subtasks, it starts over.
+    """
+
+    subtask_sec = 3.0
+    num_frames = 30  # length of the synthetic clip
+    frame_size = 256
+
+    def __init__(
+        self,
+        env_id: str,
+        num_agents: int,
+        notify_fn=None,
+        on_completed_fn=None,
+        use_cancel_command: bool = False,
+    ) -> None:
+        self.is_running = False
+
+        # callbacks
+        self.notify_fn = notify_fn
+        self.on_completed_fn = on_completed_fn
+
+        self._init_telemetry(env_id)
+
+        self.env = self  # provides get_visuals like MultiRobotSubEnvWrapper
+        x = np.arange(self.frame_size, dtype=np.uint8)
+        rows, cols = np.meshgrid(x, x, indexing="ij")
+        self.frames = [
+            rgb_to_yuv420p(np.stack([rows + 8 * t, cols, np.full_like(rows, 128)], -1)) for t in range(self.num_frames)
+        ]
+        self.num_ticks = 0  # env steps since the creation, to measure the tick rate
+
+        self.num_agents = num_agents
+        self._init_commands(use_cancel_command)
+        self.command_times = [0.0] * self.num_agents  # time each command was set
+
+    def _reset_env(self):
+        return None
+
+    async def _run(self, init_obs):
+        self.last_tick_time = None
+        while self.is_running:
+            tick_start = time.perf_counter()
+            self._observe_tick(tick_start)
+            now = time.time()
+            for idx_agent in range(self.num_agents):
+                command = self.command[idx_agent]
+                if command in ("", "cancel") or now - self.command_times[idx_agent] < self.subtask_sec:
+                    continue
+                self.policies_done_subtasks[idx_agent].append(command)
+                if len(self.policies_done_subtasks[idx_agent]) == self.num_subtasks:
+                    self.policies_done_subtasks[idx_agent] = []
+                await self.notify_fn("subtaskDone", {"agentId": idx_agent, "subtask": command})
+                self.next_acceptable_commands[idx_agent].append("")
+                await self.update_and_notify_command("", idx_agent)
+            self.num_ticks += 1
+            if time.perf_counter() - tick_start > dt_step:
+                self.tick_overruns_metric.inc()
+            await asyncio.sleep(dt_step)
+
+    async def update_and_notify_command(
+        self, command, agent_id, username=None, likelihoods=None, interaction_time=None
+    ):
+        data = await super().update_and_notify_command(command, agent_id, username, likelihoods, interaction_time)
+        if data["isNowAcceptable"] and data["hasSubtaskNotDone"]:
+            self.command_times[agent_id] = time.time()
+        return data
+
+    async def get_visuals(self, keys=None, resolutions=None):
+        keys = keys if keys is not None else [f"rgb:franka{i}_front_cam:256x256:2d" for i in range(self.num_agents)]
+        frame = self.frames[self.num_ticks % self.num_frames]
+        visuals = {key: frame for key in keys}
+        visuals["time"] = self.num_ticks * dt_step
+        return visuals
+
+
+@lru_cache(maxsize=None)
+def load_prerendered_frames(env_id: str, num_agents: int):
+    """Load the cached frames of the env, or render and cache the initial scene once.
+
+    Returns a dict of visual key to yuv420p frames of shape (T, H * 3 / 2, W). The same arrays are
+    shared by all PrerenderedEnvRunners of the process.
+    """
+    cache_path = cache_dir / f"{env_id}.npz"
+    if not cache_path.exists():
+        print(f"Rendering frames for {env_id}...")
+        env = MultiRobotSubEnvWrapper(num_agents=num_agents, max_agents_per_env=min(num_agents, 1))
+        env.reset()
+        visuals = env.sub_envs.get_visuals()
+        env.sub_envs.close()
+        keys = sorted(key for key in visuals if key.startswith("rgb:"))  # skip the sim "time"
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        np.savez_compressed(cache_path, keys=np.array(keys), frames=np.stack([visuals[k][None] for k in keys]))
+        print(f"Frames cached to {cache_path}")
+
+    with np.load(cache_path) as data:
+        # frames: (num_keys, T, H, W, 3)
+        return {
+            str(key): np.stack([rgb_to_yuv420p(frame) for frame in frames])
+            for key, frames in zip(data["keys"], data["frames"])
+        }
+
+
 # Wrapper class to breakdown envs with 4+ agents
 # into multiple sub_envs to mitigate slow simulator speed
 class MultiRobotSubEnvWrapper():
@@ -217,8 +416,11 @@ class MultiRobotSubEnvWrapper():
         # TODO: Needs to be adjusted to support other pattern of envs later on.
         sub_env_name = f"FrankaProcedural{max_agents_per_env}Robots4Col-v0"
 
+        configure_gl()
+        from app.async_vector_env import AsyncVectorEnv
+
         # AsyncVectorEnv wrapper where each env is run is a sub process, relieving the main one
-        self.sub_envs = AsyncVectorEnv([lambda: gym.make(sub_env_name)
+        self.sub_envs = AsyncVectorEnv([partial(_make_sub_env, sub_env_name)
             for _ in range(self.n_sub_envs)], shared_memory=True)
         # Additional metadata necessary for proper command distribution to the sub_envs
         self.sub_envs.max_agents_per_env = max_agents_per_env
@@ -226,17 +428,43 @@ class MultiRobotSubEnvWrapper():
 
         # Attribute for compatibility with EnvRunner
         self.action_space = self.sub_envs.single_action_space
-        # TODO: make color_dict query flexible, based on underlying envs.
-        # self.color_dict = self.sub_envs[0].color_dict
-        self.color_dict = {
-            "100": 0,
-            "010": 1,
-            "001": 2,
-            "110": 3
-        }
 
-    async def get_visuals(self):
-        return self.sub_envs.get_visuals()
+    # TODO: make color_dict query flexible, based on underlying envs.
+    # color_dict = self.sub_envs[0].color_dict
+    color_dict = {
+        "100": 0,
+        "010": 1,
+        "001": 2,
+        "110": 3
+    }
+
+    async def get_visuals(self, keys=None, resolutions=None):
+        # keys: camera keys to render, e.g. "rgb:franka3_front_cam:256x256:2d"; all cameras if None
+        # resolutions: {key: "WxH"} to render these cameras at another resolution (done in the workers)
+        # The camera images are returned as yuv420p (converted in the workers) for the video encoders
+        sub_env_indices = None
+        if keys is not None:
+            sub_env_indices = {self._robot_idx(key) // self.max_agents_per_env for key in keys}
+        sub_env_resolutions = None
+        if resolutions:
+            sub_env_resolutions = {
+                self._robot_idx(key) // self.max_agents_per_env: res for key, res in resolutions.items()
+            }
+        start = time.perf_counter()
+        visuals = self.sub_envs.get_visuals(sub_env_indices, sub_env_resolutions, pixel_format="yuv420p")
+        telemetry.env_worker_roundtrip.labels("visuals").observe(time.perf_counter() - start)
+        if keys is not None and resolutions:
+            # return the frames under the requested keys, whatever resolution they were rendered at
+            key_by_robot = {self._robot_idx(key): key for key in keys}
+            visuals = {
+                key_by_robot.get(self._robot_idx(key), key) if key.startswith("rgb:") else key: data
+                for key, data in visuals.items()
+            }
+        return visuals
+
+    @staticmethod
+    def _robot_idx(key):
+        return int(re.match(r"rgb:franka(\d+)_", key).group(1))
     
     async def step(self, action):
         # step over all envs in the AsyncVectorEnv wrapper
@@ -281,7 +509,10 @@ if __name__ == "__main__":
     mp.set_start_method("spawn")
     N_ROBOTS = 16
 
-    envs = AsyncVectorEnv([lambda: gym.make("FrankaProcedural1Robots4Col-v0")
+    configure_gl()
+    from app.async_vector_env import AsyncVectorEnv
+
+    envs = AsyncVectorEnv([partial(_make_sub_env, "FrankaProcedural1Robots4Col-v0")
                             for _ in range(N_ROBOTS)])
 
     # Testing LED on / off pure async toggle fns
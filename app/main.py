@@ -4,65 +4,104 @@ import multiprocessing as mp
 import os
 import secrets
 import string
+import time
 import urllib.parse
 import uuid
 from datetime import datetime
 from http.cookies import SimpleCookie
 from pathlib import Path
-from typing import Dict, List, Optional, Union
+from typing import Dict, Optional
 
 import socketio
 import uvicorn
 from aiortc import RTCPeerConnection
 from dotenv import load_dotenv
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import RedirectResponse, JSONResponse
-from fastapi.staticfiles import StaticFiles
+from fastapi.responses import RedirectResponse, JSONResponse, Response
 from fastapi.templating import Jinja2Templates
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 from starlette.middleware.sessions import SessionMiddleware
 
-from app.env import EnvRunner
-from app.stream import StreamManager
+from app.cluster import (
+    SharedStore,
+    get_num_workers,
+    get_session_secret_key,
+    get_worker_index,
+    worker_for_mode,
+)
+from app.env import BenchmarkEnvRunner, EnvRunner, PrerenderedEnvRunner, dt_step, load_prerendered_frames
+from app.recorder import SessionRecorder
+from app.registry import SessionRegistry
+from app.scheduler import EnvScheduler
+from app.stream import StreamManager, camera_key, focus_resolution, mosaic_layout
 from app.utils.metrics import InteractionRecorder, compute_sessionmetrics, compute_usermetrics, taskCompletionTimer
-from app.utils.webrtc import createPeerConnection, handle_answer, handle_candidate, handle_offer_request
+from app.utils import telemetry
+from app.utils.persistence import PersistenceWorker
+from app.utils.ratelimit import BoundedAsyncServer, TokenBucket
+from app.utils.startup import startup_timer
+from app.utils.static import HashedStaticFiles
+from app.utils.watchdog import LoopWatchdog
+from app.utils.wire import decode_request, encode_event, wire_formats
+from app.utils.webrtc import (
+    PeerConnectionPool,
+    createPeerConnection,
+    handle_answer,
+    handle_candidate,
+    handle_offer_request,
+)
 from app.scripts.anonymize import hash_string
 
+startup_timer.mark("interpreter and imports")
 load_dotenv()
 
 app = FastAPI()
 
-secret_key = os.getenv("SESSION_SECRET_KEY")
-if secret_key is None:
-    secret_key = secrets.token_urlsafe(32)
-    with open(Path(__file__).parent / ".env", "a") as f:
-        f.write(f"SESSION_SECRET_KEY={secret_key}\n")
-app.add_middleware(SessionMiddleware, secret_key=secret_key)
+app.add_middleware(SessionMiddleware, secret_key=get_session_secret_key())
 
 app_dir = Path(__file__).parent
-app.mount("/static", StaticFiles(directory=app_dir / "static"), name="static")
+static_files = HashedStaticFiles(app_dir / "static", app_dir / "static_build")  # see app/scripts/build_static.py
+app.mount("/static", static_files, name="static")
 templates = Jinja2Templates(directory=app_dir / "templates")
-
-sio = socketio.AsyncServer(async_mode="asgi", cors_allowed_origins="*")  # TODO
+templates.env.globals["static_url"] = static_files.url
+templates.env.globals["static_import_map"] = static_files.import_map
+
+# when run with app/cluster.py, the workers share some session state through the broker
+cluster_socket = os.getenv("CLUSTER_SOCKET")
+worker_index = get_worker_index()
+sio = BoundedAsyncServer(
+    async_mode="asgi",
+    cors_allowed_origins="*",  # TODO
+    max_queued_packets=int(os.getenv("MAX_QUEUED_PACKETS", 256)),  # per client; events to slower clients are dropped
+)
+shared_store = SharedStore(cluster_socket)  # session state shared by the workers of the cluster
 socket_app = socketio.ASGIApp(sio, other_asgi_app=app)
 
-envs: Dict[str, EnvRunner] = {}  # EnvRunners for each mode
-stream_manager = StreamManager()  # manage streams for each mode
+envs: Dict[str, EnvRunner] = {}  # EnvRunners for each env instance
+stream_manager = StreamManager()  # manage streams for each env instance
+stream_keys: Dict[str, str] = {}  # stream for each env instance; prerendered instances share one
+record_session_video = os.getenv("RECORD_SESSION_VIDEO", "0") == "1"
+session_recorders: Dict[str, SessionRecorder] = {}  # video recorder of the running session of each env instance
 
-modes: Dict[str, str] = {}  # mode for each client
-envs: Dict[str, EnvRunner] = {}  # EnvRunners for each client
+# NOTE: several instances of the same mode can run concurrently. Below, `mode` keys refer to
+# the instance id (e.g. "multi-robot-4.0") unless stated otherwise; see app/scheduler.py
+registry = SessionRegistry()  # browsers (by unique_user_id) and socket.io clients (by sid)
 peer_connections: Dict[str, RTCPeerConnection] = {}  # RTCPeerConnections for each client
+peer_connection_pools: Dict[str, PeerConnectionPool] = {}  # pre-gathered RTCPeerConnections for each mode
+prerendered_frames_loads: Dict[str, asyncio.Future] = {}  # loading of the frames of each prerendered mode
 
-sid2userid: Dict[str, str] = {}  # user_i d for each sid
-sid2username: Dict[str, str] = {}  # user_name for each sid
-mode2expids: Dict[str, str] = {}  # exp_id for each mode
-task_completion_timers: Dict[str, taskCompletionTimer] = {}  # taskCompletionTimer for each mode
+mode2expids: Dict[str, str] = {}  # exp_id for each env instance
+task_completion_timers: Dict[str, taskCompletionTimer] = {}  # taskCompletionTimer for each env instance
 interaction_recorders: Dict[str, InteractionRecorder] = {}
-uniq_client_sids: Dict[str, Dict] = {}  # Uniquely id a browser session (tab ?), track user info if applicable.
+persistence_worker = PersistenceWorker()  # saves logs and metrics off the event loop
+loop_watchdog = LoopWatchdog(threshold_sec=float(os.getenv("LOOP_STALL_THRESHOLD_MS", 100)) / 1000)
+# required by the /api/admin endpoints; without it, only local requests are served
+admin_token = os.getenv("ADMIN_TOKEN")
 
 env_info = {
     "data-collection": {
         "env_id": "FrankaPickPlaceSingle4Col-v1",
         "num_agents": 1,
+        "prerendered": True,  # no simulation; the cached scene is shared by all users
     },
     "single-robot": {
         "env_id": "FrankaProcedural1Robots4Col-v0",
@@ -71,13 +110,38 @@ env_info = {
     "multi-robot-4": {
         "env_id": "FrankaProcedural4Robots4Col-v0",
         "num_agents": 4,
+        "mosaic": False,  # send all cameras tiled in a single video track
     },
     "multi-robot-16": {
         "env_id": "FrankaProcedural16Robots4Col-v0",
-        "num_agents": 16
+        "num_agents": 16,
+        "mosaic": False,
     },
 }
 countdown_sec = 3
+benchmark_env = os.getenv("BENCHMARK_ENV", "0") == "1"  # stand-in env without simulation for load tests
+command_rate = float(os.getenv("COMMAND_RATE", 10))  # commands per second allowed to each client
+command_burst = int(os.getenv("COMMAND_BURST", 20))
+wire_format = os.getenv("WIRE_FORMAT", "json")  # encoding of command/subtaskDone events; see app/utils/wire.py
+assert wire_format in wire_formats, f"Unknown WIRE_FORMAT: {wire_format}"
+user_list_debounce_sec = 0.2  # user list changes within this window are sent at once
+user_lists_sent: Dict[str, list] = {}  # last user list sent to each env instance
+user_list_task: Optional[asyncio.Task] = None
+env_scheduler = EnvScheduler(env_info, use_sub_envs=not benchmark_env)  # places clients on env instances
+
+
+async def load_prerendered_frames_in_thread(base_mode: str):
+    # rendering them on a cache miss takes seconds, which must not block the other clients
+    if base_mode not in prerendered_frames_loads:
+        prerendered_frames_loads[base_mode] = asyncio.get_running_loop().run_in_executor(
+            None, load_prerendered_frames, env_info[base_mode]["env_id"], env_info[base_mode]["num_agents"]
+        )
+    try:
+        await prerendered_frames_loads[base_mode]
+    except Exception:
+        prerendered_frames_loads.pop(base_mode, None)  # retried by the next client
+        raise
+
 
 # Helpers for tracking a specific user across browser sessions
 ## Tracking a user based on the browser cookie
@@ -96,43 +160,73 @@ def get_uniq_client_sid(request: Request, mode: str = None):
         unique_user_id = str(uuid.uuid4())
 
     # Global tracking of browsers that attempted connection
-    if unique_user_id not in list(uniq_client_sids.keys()):
-        # User connection status is handled either here, or
-        # in disconnect_user call.
-        uniq_client_sids[unique_user_id] = {}
+    # User connection status is handled either here, or
+    # in disconnect_user call.
+    browser = registry.touch_browser(unique_user_id)
 
     # If request / cookies also carry userinfo, refresh
     userinfo = request.session.get("userinfo", None)
     if userinfo is not None:
-        uniq_client_sids[unique_user_id]["username"] = userinfo["name"]
+        registry.set_username(browser, userinfo["name"])
 
     # If this is called, user is connected
-    uniq_client_sids[unique_user_id]["connected"] = True
+    registry.set_connected(browser, True)
     # Set mode that prompted this user id query
     if mode is not None: # workaround /api/getuser resetting the mode.
-        uniq_client_sids[unique_user_id]["current-mode"] = mode
-
-    # DBG
-    # print("")
-    # print("#### DBG: Tracking Client Sessions")
-    # for userid, uuid_data in uniq_client_sids.items():
-    #     print(f"  {userid} => {uuid_data['username']}")
-    #     print(f"    connected: {uuid_data['connected']}")
-    #     print(f"    curr-mode: {uuid_data['current-mode']}")
-    # print("")
+        browser.current_mode = mode
+        if mode not in env_info:
+            # left the task page; not listed in the instance anymore
+            registry.set_instance(browser, None)
+            broadcast_user_lists()
+    share_browser(browser)
 
     return unique_user_id
 
-def get_connected_users_list(ignore_names: Optional[Union[str, List[str]]] = []):
-    return [client_data.get("username", None) for client_data in uniq_client_sids.values()
-        if (client_data.get("connected", False)
-            and client_data.get("username", "") not in ignore_names)]
 
-def get_connected_users_list_by_mode(mode: str):
-    return [client_data.get("username", None) for client_data in uniq_client_sids.values()
-                if (client_data.get("username", "") != ""
-                    and client_data.get("connected", False)
-                    and client_data.get("current-mode", None) == mode)]
+def share_browser(browser):
+    # other workers check the usernames in use against the shared store
+    if cluster_socket is None or not browser.username:
+        return
+    claim = {"unique_user_id": browser.unique_user_id, "connected": browser.connected, "worker": worker_index}
+    asyncio.create_task(_set_shared(f"user:{browser.username}", claim))
+
+
+async def _set_shared(key: str, value):
+    try:
+        await shared_store.set(key, value)
+    except Exception as e:
+        print(f"Failed to share {key}: {e!r}")
+
+
+async def is_username_connected(username: str):
+    if registry.is_username_connected(username):
+        return True
+    claim = await shared_store.get(f"user:{username}")
+    return claim is not None and claim["worker"] != worker_index and claim["connected"]
+
+
+def broadcast_user_lists():
+    # changes are coalesced, e.g. when a group joins at once
+    global user_list_task
+    if user_list_task is None or user_list_task.done():
+        user_list_task = asyncio.create_task(_send_changed_user_lists())
+
+
+async def _send_changed_user_lists():
+    await asyncio.sleep(user_list_debounce_sec)
+    # Changes marked while emitting are sent by the next round, as this task is still running
+    while changed_instances := registry.pop_changed_instances():
+        # Only clients in the same env instance are listed together
+        for instance_id in changed_instances:
+            if instance_id not in env_scheduler.instances:
+                user_lists_sent.pop(instance_id, None)  # released
+                continue
+            user_list = sorted(registry.get_connected_usernames(instance_id))
+            if user_list == user_lists_sent.get(instance_id):
+                continue
+            user_lists_sent[instance_id] = user_list
+            mode = env_scheduler.get_mode(instance_id)
+            await sio.emit(f"userListUpdate-{mode}", user_list, room=instance_id)
 
 def track_client_session(request: Request, unique_user_id: str):
     # NOTE: Leaving this for reference, because the request.cookies["session"]
@@ -140,10 +234,7 @@ def track_client_session(request: Request, unique_user_id: str):
     # General format is eyJ1c2VyaW5...mlnaHQifX0=.Zo3zYQ.6fYG6IudrvJ814N4fpfrDwFAGlM
     # If using split(".") for e.g., [0] is mostly consistent for the same browser/user
     full_session_id = request.cookies['session']
-    # uniq_client_sids[unique_user_id]["all_sessions"].append(full_session_id)
-    # DBG code
-    # for sidx, seshid in enumerate(uniq_client_sids[unique_user_id]["all_sessions"]):
-    #     print(f"  {sidx} -> {seshid}")
+    # browser.all_sessions.append(full_session_id)
     return full_session_id
 
 
@@ -159,9 +250,7 @@ async def setuser(request: Request, userinfo: dict):
 
     # If another user with a different browser is detected,
     # reject this name choice
-    # current_name = uniq_client_sids[unique_user_id].get("username", "")
-    connected_user_list = get_connected_users_list() #(ignore_names=current_name)
-    if username in connected_user_list:
+    if await is_username_connected(username):
         # NOTE: naive error handling, but more complex not needed for now
         raise HTTPException(
             status_code=400,
@@ -171,7 +260,9 @@ async def setuser(request: Request, userinfo: dict):
         )
 
     # Associate unique client id to the username
-    uniq_client_sids[unique_user_id]["username"] = username
+    browser = registry.touch_browser(unique_user_id)
+    registry.set_username(browser, username)
+    share_browser(browser)
 
     return True
 
@@ -184,41 +275,51 @@ async def save_nasa_tlx_data(request: Request, survey_data: dict):
 
     username = survey_data['userinfo']['name']
     sub_log_dir = log_dir / f"{username}"
-    sub_log_dir.mkdir(parents=True, exist_ok=True)
-
 
-    time_id = mode2expids[mode]
+    # mode2expids is keyed by env instance, so the client sends back the expId it was given
+    time_id = survey_data.get("expId") or mode2expids.get(mode)
+    if time_id is None:
+        raise HTTPException(
+            status_code=400,
+            detail={
+                "errors": ["unknown-experiment"]
+            }
+        )
     session_name = f"{time_id}" #might want to make bids format
 
     survey_path = sub_log_dir / session_name
-    survey_path.mkdir(parents=True, exist_ok=True)
 
     #remove fields other than survey data
     saved_data = survey_data.copy()
-    keys_to_remove = ['mode', 'userinfo', 'device-selection']
+    keys_to_remove = ['mode', 'expId', 'userinfo', 'device-selection']
     for key in keys_to_remove:
         saved_data.pop(key, None)
 
+    await persistence_worker.run(f"survey of {username}", _save_survey, survey_path, saved_data)
+    return True
+
+
+def _save_survey(survey_path: Path, saved_data: dict):
+    survey_path.mkdir(parents=True, exist_ok=True)
     file_name = "nasatlx.json"
     with open(survey_path / file_name, mode="w") as f:
         json.dump(saved_data, f, indent=4)
 
-    return True
-
 @app.post("/api/disconnect-user")
 async def disconnect_user(request: Request, data: dict):
     unique_user_id = data["unique_user_id"]
     print(f"User associated with: {unique_user_id} navigated away or left.")
     # TODO: Maybe don't do this on "unload" ? Just
     # beforeunload when the tab is actually closed ?
-    if unique_user_id in uniq_client_sids.keys():
-        uniq_client_sids[unique_user_id]["connected"] = False
-        uniq_client_sids[unique_user_id]["current-sid"] = None
-        # TODO: reset "current-mode" ? Or keep it as is ?
+    browser = registry.get_browser(unique_user_id)
+    if browser is not None:
+        registry.set_connected(browser, False)
+        browser.current_sid = None
+        share_browser(browser)
+        # TODO: reset "current_mode" ? Or keep it as is ?
 
-    # Broadcast the updated list of connected user IDs to all clients
-    for mode in list(env_info.keys()):
-        await sio.emit(f"userListUpdate-{mode}", get_connected_users_list_by_mode(mode))
+    # Broadcast the updated list of connected user IDs to the instances where it changed
+    broadcast_user_lists()
 
 
 @app.get("/api/getuser")
@@ -262,13 +363,20 @@ async def index(request: Request):
 
 
 async def task_page(request: Request, mode: str):
+    # in a cluster, the page, the API calls and the socket of a mode are all served by the worker owning it
+    owner = worker_for_mode(mode, list(env_info), get_num_workers())
+    if worker_index is not None and owner != worker_index:
+        port = int(os.getenv("CLUSTER_BASE_PORT", 8000)) + owner
+        return RedirectResponse(url=str(request.url.replace(port=port)))
+
     unique_user_id = get_uniq_client_sid(request, mode=mode) # Tracking uniq user
 
     if "userinfo" not in request.session:
         return RedirectResponse(url="/register")
 
     # restrict users from joining in the middle of an experiment
-    if mode in envs and envs[mode].is_running:
+    # when no other instance of the mode can be started
+    if not env_scheduler.can_admit(mode):
         request.session["flash"] = {
             "message": "The experiment is already running.\nPlease wait for it to finish.",
             "category": "warning",
@@ -342,7 +450,6 @@ async def connect(sid, environ):
     # How bad would it be ?
     alphabet = string.ascii_uppercase + string.digits
     user_id = "".join(secrets.choice(alphabet) for _ in range(8))
-    sid2userid[sid] = user_id
     # get mode
     query = urllib.parse.parse_qs(environ.get("QUERY_STRING", ""))
     endpoint = query.get("endpoint", [None])[0]
@@ -350,27 +457,51 @@ async def connect(sid, environ):
     mode = endpoint[1:] #get mode here for connect
 
     # Update current sid for the connected user
-    # NOTE: this will break if reloading the page between
-    # server restarts. Maybe add a try-catch for clean handling ?
-    uniq_client_sids[unique_user_id]["current-sid"] = sid
+    # NOTE: the browser is registered again if the page is reloaded between server restarts
+    browser = registry.touch_browser(unique_user_id)
+    browser.current_sid = sid
 
     if mode not in env_info:
         return False
 
-    # get or create env
-    if mode in envs:
-        env = envs[mode]
-    else:
-        env = EnvRunner(
-            env_info[mode]["env_id"],
-            num_agents=env_info[mode]["num_agents"],
-            notify_fn=lambda event, data: sio.emit(event, data, room=mode),
-            on_completed_fn=lambda: asyncio.create_task(on_completed(mode)),
+    # place the client on an env instance; data collection users get a private one
+    instance_id = env_scheduler.assign(mode, mode + user_id if mode == "data-collection" else None)
+    if instance_id is None:
+        print(f"No capacity left for {mode}")
+        return False
+    registry.set_instance(browser, instance_id)
+    base_mode, mode = mode, instance_id
+
+    try:
+        # get or create env
+        runner_cls = PrerenderedEnvRunner if env_info[base_mode].get("prerendered", False) else EnvRunner
+        if benchmark_env:
+            runner_cls = BenchmarkEnvRunner
+        if mode not in envs and runner_cls is PrerenderedEnvRunner:
+            await load_prerendered_frames_in_thread(base_mode)  # the runner then gets them from the cache
+        if mode in envs:
+            env = envs[mode]
+        else:
+            env = runner_cls(
+                env_info[base_mode]["env_id"],
+                num_agents=env_info[base_mode]["num_agents"],
+                notify_fn=lambda event, data: sio.emit(event, encode_event(event, data, wire_format), room=mode),
+                on_completed_fn=lambda: asyncio.create_task(on_completed(mode)),
+            )
+            envs[mode] = env
+            stream_keys[mode] = base_mode if isinstance(env, PrerenderedEnvRunner) else mode
+            stream_manager.setup(
+                stream_keys[mode],
+                env.env.get_visuals,
+                env.num_agents,
+                mosaic=env_info[base_mode].get("mosaic", False),
             )
-        if mode == "data-collection":
-            mode = mode + user_id
-        envs[mode] = env
-        stream_manager.setup(mode, env.env.get_visuals, env.num_agents)
+    except Exception:
+        # e.g. missing prerendered frames: free the place of the client, and the instance if created for it
+        if env_scheduler.leave(mode) and mode not in envs:
+            env_scheduler.release(mode)
+        registry.set_instance(browser, None)
+        raise
 
     # NOTE: Init expId earlier than request_server_start
     # for EMG / EEG pipeline compatibility
@@ -384,13 +515,21 @@ async def connect(sid, environ):
             "isDataCollection": mode.startswith("data-collection"),
             "commandLabels": env.command_labels,
             "commandColors": env.command_colors,
+            "mosaicLayout": _get_mosaic_layout(base_mode),
+            "numAgents": env.num_agents,
+            "wireFormat": wire_format,
         },
         to=sid,
     )
-    modes[sid] = mode
+    client = registry.add_client(sid, user_id, mode)
+    client.unique_user_id = unique_user_id
+    client.command_bucket = TokenBucket(command_rate, command_burst)
     await sio.enter_room(sid, mode)
 
-    peer_connections[sid] = createPeerConnection(sio, sid) #HD
+    if base_mode not in peer_connection_pools:
+        num_tracks = 1 if env_info[base_mode].get("mosaic", False) else env.num_agents
+        peer_connection_pools[base_mode] = PeerConnectionPool(num_tracks)
+    peer_connections[sid] = createPeerConnection(sio, sid, peer_connection_pools[base_mode].acquire())
 
     # get or create metrics
     if mode not in interaction_recorders:
@@ -401,59 +540,98 @@ async def connect(sid, environ):
     # send initial server status
     await sio.emit("status", "Ready.", to=sid)
 
-    # Broadcast the updated list of connected user IDs to all clients in the same mode
-    # await sio.emit("userListUpdate", get_connected_users_list())
-    await sio.emit(f"userListUpdate-{mode}", get_connected_users_list_by_mode(mode))
+    # Send the list of connected user IDs to the new client, and to the others if it changed
+    await sio.emit(f"userListUpdate-{base_mode}", sorted(registry.get_connected_usernames(mode)), to=sid)
+    broadcast_user_lists()
+
+
+def _get_mosaic_layout(mode: str):
+    if not env_info[mode].get("mosaic", False):
+        return None
+    cols, rows = mosaic_layout(env_info[mode]["num_agents"])
+    return {"cols": cols, "rows": rows}
 
 
 @sio.event
 async def disconnect(sid):
     print("Client disconnected:", sid)
-    # remove id
-    if sid in sid2userid:
-        del sid2userid[sid]
-
-    # close peer connection
-    if sid in peer_connections:
-        await peer_connections[sid].close()
-        del peer_connections[sid]
-
-    # remove mode entry
-    assert sid in modes
-    mode = modes[sid]
-    del modes[sid]
-
-    # Check if no other clients are using this mode
-    if all(m != mode for m in modes.values()):
+    await _close_peer_connection(sid)
+    stream_manager.unsubscribe_images(sid)
+
+    # remove the client entry
+    client = registry.remove_client(sid)
+    assert client is not None
+    mode = client.instance_id
+    browser = registry.get_browser(client.unique_user_id)
+    if browser is not None and browser.current_sid == sid:
+        # not reloaded into another socket; not listed in the instance anymore
+        browser.current_sid = None
+        registry.set_instance(browser, None)
+
+    if client.focus_id is not None:
+        update_focus(mode)
+
+    # Check if no other clients are using this instance
+    if env_scheduler.leave(mode):
+        await _stop_recording(mode)
         # cleanup streams
-        await stream_manager.cleanup(mode)
+        await stream_manager.cleanup(stream_keys.pop(mode))
         # stop and delete the environment
         if envs[mode].is_running:
             await envs[mode].stop()
         del envs[mode]
         print(f"Environment for {mode} is deleted")
         # delete metrics
-        del interaction_recorders[mode]
+        interaction_recorders.pop(mode).close()
         del task_completion_timers[mode]
+        # free the cores of the instance for other groups
+        env_scheduler.release(mode)
 
-    # Broadcast the updated list of connected user IDs to all clients
-    for mode in list(env_info.keys()):
-        await sio.emit(f"userListUpdate-{mode}", get_connected_users_list_by_mode(mode))
+    # Broadcast the updated list of connected user IDs to the instances where it changed
+    broadcast_user_lists()
+
+
+async def _close_peer_connection(sid: str):
+    await stream_manager.stop_adaptation(sid)
+    if sid in peer_connections:
+        # stop tracks so that the shared encoders stop sending packets to this client
+        for sender in peer_connections[sid].getSenders():
+            if sender.track is not None:
+                sender.track.stop()
+        await peer_connections[sid].close()
+        del peer_connections[sid]
+        telemetry.webrtc_peers.dec()
 
 
 async def on_completed(mode: str):
     task_completion_timers[mode].stop()
     time_id = mode2expids[mode]
+    comp_time = task_completion_timers[mode].elapsed
+
+    # hand the session over; the logs are saved in the background while clients are notified right away
+    recorder = interaction_recorders[mode].detach()
+    usernames = recorder.usernames
+    clients = {username: registry.get_client_by_username(username) for username in usernames}
+    userids = {username: client.user_id for username, client in clients.items() if client is not None}
+
+    async def on_saved(error):
+        status = {"expId": time_id, "saved": error is None}
+        await sio.emit("persistenceStatus", status, room=mode)
+
+    persistence_worker.submit(
+        f"session {time_id}", _save_session, time_id, recorder, comp_time, userids, on_done=on_saved
+    )
+    await _server_stop(mode, is_completed=True)
+
+
+def _save_session(time_id: str, recorder: InteractionRecorder, comp_time: float, userids: Dict[str, str]):
     # get session info for folder names
     session_name = f"{time_id}"
     session_log_dir = log_dir / session_name
     session_log_dir.mkdir(parents=True, exist_ok=True)
-    
-
-    comp_time = task_completion_timers[mode].elapsed
 
     #save interaction history for session
-    usernames = interaction_recorders[mode].save_session(session_log_dir) 
+    usernames = recorder.save_session(session_log_dir)
 
     for username in usernames: 
         if os.path.exists(log_dir / hash_string(username)): #if user data has previously been anonymized
@@ -462,35 +640,43 @@ async def on_completed(mode: str):
         else:
             user_log_dir = log_dir / username / session_name
 
-        sid = [sid for sid, name in sid2username.items() if name == username][0]
-        userid = sid2userid[sid]
         compute_usermetrics(user_log_dir, username, save = True) 
-        interaction_recorders[mode].save_userinfo(user_log_dir, userid)
+        if username not in userids:
+            print(f"{username} is not connected anymore, user info not saved")
+            continue
+        recorder.save_userinfo(user_log_dir, userids[username])
 
     compute_sessionmetrics(session_log_dir,info = comp_time,  save=True) 
-    await _server_stop(mode, is_completed=True)
 
 
 @sio.on("addUser")
 async def add_user(sid, data):
     # NOTE: call this after "taskStartRequested" since the interaction recorder is reset at the start
-    mode = modes[sid]
-    interaction_recorders[mode].add_user(sid2userid[sid], data)
+    client = registry.get_client(sid)
+    interaction_recorders[client.instance_id].add_user(client.user_id, data)
     return True
 
 
 @sio.on("requestServerStart") # getting username here to use as key to find exp_id is not trivial. connected users doesnt show all users here yet.
 async def server_start(sid):
-    mode = modes[sid]
+    mode = registry.get_client(sid).instance_id
     env = envs[mode]
-    assert not env.is_running
-
-    # Initialize metrics and start env
-    interaction_recorders[mode].reset()
+    # the instance is marked running before the first await, so that a second request is rejected
+    assert not env.is_running and not env_scheduler.instances[mode].is_running
+    env_scheduler.set_running(mode, True)  # new clients of this mode go to another instance
+
+    # Initialize metrics and start env; the history is written to the session logs as it is recorded.
+    # A restarted session replaces the history file of the previous one, so the previous writer and
+    # the saving of a completed session (jobs run in order) must be done with it first.
+    recorder = interaction_recorders[mode]
+    await persistence_worker.run(f"history of {mode}", recorder.close, True)
+    recorder.reset(log_dir / mode2expids[mode] / "history.jsonl")
     task_completion_timers[mode].start()
     # start all clients in the mode
     await sio.emit("requestClientStart", room=mode)
     env.start()
+    if record_session_video:
+        _start_recording(mode)
 
     # countdown
     for i in range(countdown_sec, 0, -1):
@@ -505,24 +691,76 @@ async def server_start(sid):
 
 @sio.on("requestServerStop")
 async def server_stop(sid, is_completed: bool = False):
-    return await _server_stop(modes[sid], is_completed)
+    return await _server_stop(registry.get_client(sid).instance_id, is_completed)
 
 
 async def _server_stop(mode, is_completed: bool = False):
     env = envs[mode]
     assert env.is_running
     await env.stop()
+    env_scheduler.set_running(mode, False)
+    recorder = session_recorders.pop(mode, None)
     await sio.emit("requestClientStop", is_completed, room=mode)  # notify clients that the env is stopped
     await sio.emit("status", "Completed!" if is_completed else "Stopped.", room=mode)
+    if recorder is not None:
+        await recorder.stop()  # after notifying the clients, as flushing the videos takes a while
     return True
 
 
+def _start_recording(mode: str):
+    # videos are saved next to the session logs, see on_completed
+    stream_key = stream_keys[mode]
+    base_mode = env_scheduler.get_mode(mode)
+    session_recorders[mode] = SessionRecorder(
+        stream_manager.capturers[stream_key],
+        [camera_key(i) for i in range(stream_manager.num_tracks[stream_key])],
+        log_dir / mode2expids[mode] / "video",
+        mosaic=env_info[base_mode].get("mosaic", False),
+        # focused cameras are rendered larger, thumbnails are scaled up to it
+        resolution=focus_resolution if stream_manager.can_focus(stream_key) else None,
+    )
+
+
+async def _stop_recording(mode: str):
+    if mode in session_recorders:
+        await session_recorders.pop(mode).stop()
+
+
 @sio.on("command")
-async def command(sid, data: dict):
-    mode = modes[sid]
+async def command(sid, payload):
+    client = registry.get_client(sid)
+    data = decode_request("command", payload)
+    if client.pending_command is not None:
+        # over the rate limit: only the latest command is kept, older ones are stale
+        telemetry.events_throttled.labels("command").inc()
+        telemetry.events_dropped.labels("stale").inc()
+        client.pending_command = data
+        return
+    if client.command_bucket.try_take():
+        await _handle_command(client, data)
+        return
+
+    telemetry.events_throttled.labels("command").inc()
+    client.pending_command = data
+    asyncio.create_task(_handle_pending_command(client))
+
+
+async def _handle_pending_command(client):
+    while not client.command_bucket.try_take():
+        await asyncio.sleep(client.command_bucket.time_until_available())
+    data, client.pending_command = client.pending_command, None
+    if registry.get_client(client.sid) is not client:
+        return  # disconnected in the meantime
+    await _handle_command(client, data)
+
+
+async def _handle_command(client, data: dict):
+    start = time.perf_counter()
+    mode = client.instance_id
+    telemetry.commands.labels(env_scheduler.get_mode(mode)).inc()
     agent_id = data["agentId"]
     command_label = data["command"]
-    username = sid2username[sid]
+    username = client.username
     res = await envs[mode].update_and_notify_command(
         command_label,
         agent_id,
@@ -533,29 +771,139 @@ async def command(sid, data: dict):
 
     if res["interactionTime"] is not None:  # TODO: recording only acceptable interactions
         res.pop("nextAcceptableCommands")  # delete unnecessary item
-        interaction_recorders[mode].record(sid2userid[sid], res)
+        interaction_recorders[mode].record(client.user_id, res)
+
+    telemetry.command_handling_time.observe(time.perf_counter() - start)
+
+
+def update_focus(mode: str):
+    # cameras focused by any client of the instance are rendered in high resolution
+    focused = {client.focus_id for client in registry.get_clients(mode) if client.focus_id is not None}
+    if mode in stream_keys:
+        stream_manager.set_focus(stream_keys[mode], focused)
+
+
+@sio.on("focus")
+async def focus(sid, focus_id: Optional[int]):
+    client = registry.get_client(sid)
+    client.focus_id = focus_id
+    update_focus(client.instance_id)
 
-    print(f"Command {command_label} by {username} is sent to {agent_id}")
 
 @sio.on("webrtc-offer-request")
 async def webrtc_offer_request(sid, userinfo):
+    start = time.time()
     pc = peer_connections[sid]
-    mode = modes[sid]
+    client = registry.get_client(sid)
+    mode = client.instance_id
 
-    keys_to_remove = [key for key, value in sid2username.items() if value == userinfo["name"]]
-    for key in keys_to_remove:
-        sid2username.pop(key)
+    registry.set_client_username(client, userinfo["name"])
 
-    sid2username[sid] = userinfo["name"]
-
-    # add stream tracks
-    tracks = stream_manager.get_tracks(mode)
-    for track in tracks:
-        pc.addTransceiver(track, direction="sendonly")
+    # attach stream tracks to the transceivers created with the peer connection, all negotiated in one offer
+    tracks = stream_manager.get_tracks(stream_keys[mode])
+    for transceiver, track in zip(pc.getTransceivers(), tracks):
+        transceiver.sender.replaceTrack(track)
         print(f"Track {track.id} added to peer connection")
 
-
     await handle_offer_request(pc, sio, sid)
+    stream_manager.start_adaptation(sid, pc)  # adapt the quality of each track to the client's link
+    asyncio.create_task(_measure_setup_time(client, tracks, start))
+
+
+async def _measure_setup_time(client, tracks: list, start: float):
+    try:
+        await asyncio.wait_for(tracks[0].first_packet_sent.wait(), timeout=60)
+    except asyncio.TimeoutError:
+        print(f"No video sent to {client.sid} within 60 s of the offer request")
+        return
+    client.setup_time = time.time() - start
+    telemetry.webrtc_setup_time.observe(client.setup_time)
+    print(f"WebRTC setup for {client.sid}: {client.setup_time:.2f} s from the offer request to the first video packet")
+
+
+@sio.on("image-stream-request")
+async def image_stream_request(sid):
+    # the client could not establish WebRTC; send the cameras as images over socket.io instead
+    print(f"WebRTC failed for {sid}, falling back to images")
+    await _close_peer_connection(sid)
+    stream_manager.subscribe_images(
+        stream_keys[registry.get_client(sid).instance_id],
+        sid,
+        lambda payload, callback: sio.emit("frame", payload, to=sid, callback=callback),
+    )
+
+
+@app.get("/api/benchmark-stats")
+async def benchmark_stats():
+    # polled by app/scripts/load_test.py
+    if not benchmark_env:
+        raise HTTPException(status_code=404)
+    stats = {
+        "time": time.time(),
+        "cpuTime": time.process_time(),
+        "maxLoopLag": loop_watchdog.pop_max_lag(),  # since the previous call
+        "targetTickRate": 1 / dt_step,
+        "envTicks": {mode: env.num_ticks for mode, env in envs.items() if isinstance(env, BenchmarkEnvRunner)},
+    }
+    return stats
+
+
+@app.get("/metrics")
+async def metrics():
+    # Prometheus text format
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+@app.on_event("startup")
+async def start_loop_watchdog():
+    loop_watchdog.start()
+    startup_timer.mark("server startup")
+
+
+@app.on_event("shutdown")
+async def close_peer_connection_pools():
+    for pool in peer_connection_pools.values():
+        await pool.close()
+    peer_connection_pools.clear()
+
+
+@app.on_event("startup")
+async def prerender_frames():
+    # in the background, so that the first client of a prerendered mode does not wait for them
+    for mode, info in env_info.items():
+        owner = worker_for_mode(mode, list(env_info), get_num_workers())
+        if info.get("prerendered", False) and not benchmark_env and worker_index in (None, owner):
+            asyncio.create_task(load_prerendered_frames_in_thread(mode))
+
+
+if startup_timer.enabled:
+
+    @app.middleware("http")
+    async def report_startup_time(request: Request, call_next):
+        response = await call_next(request)
+        if not startup_timer.done:
+            startup_timer.mark(f"first response ({request.url.path})")
+            startup_timer.report()
+        return response
+
+
+def _check_admin(request: Request):
+    if admin_token is not None:
+        if not secrets.compare_digest(request.query_params.get("token", ""), admin_token):
+            raise HTTPException(status_code=403)
+    elif request.client is None or request.client.host not in ("127.0.0.1", "::1"):
+        raise HTTPException(status_code=403)
+
+
+@app.get("/api/admin/loop-stalls")
+async def loop_stalls(request: Request, limit: int = 20):
+    # stalls of the event loop with the stack of the code that held it, newest first
+    _check_admin(request)
+    return {
+        "thresholdSec": loop_watchdog.threshold_sec,
+        "numStalls": loop_watchdog.num_stalls,  # since the server started, including those out of the buffer
+        "stalls": loop_watchdog.get_stalls(limit),
+    }
 
 
 @sio.on("webrtc-answer")
@@ -568,6 +916,8 @@ async def webrtc_ice(sid, data):
     await handle_candidate(peer_connections[sid], data)
 
 
+startup_timer.mark("app setup")
+
 if __name__ == "__main__":
     # Require within __main__ for rendering in parallel sub envs.
     mp.set_start_method("spawn")
@@ -578,7 +928,7 @@ if __name__ == "__main__":
     uvicorn.run(
         socket_app,
         host="0.0.0.0",
-        port=8000,
+        port=int(os.getenv("PORT", 8000)),
         ssl_keyfile=str(key_dir / "server.key"),
         ssl_certfile=str(key_dir / "server.crt"),
     )
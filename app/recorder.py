@@ -0,0 +1,159 @@
+import asyncio
+import fractions
+import multiprocessing as mp
+import queue
+import time
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+from app.stream import FrameCapturer, mosaic_layout, tile_frames
+from app.utils.video import yuv420p_planes
+
+recording_fps = 15
+recording_bitrate = 1_000_000
+max_queued_frames = 30  # frames waiting for the recording process; newer frames are dropped when full
+stop_timeout_sec = 10  # time given to the recording process to flush the videos
+
+
+class SessionRecorder:
+    """Records the frames of a FrameCapturer to video files during a session.
+
+    It subscribes to the capturer like the encoders of the live stream, and sends the frames to a
+    separate process which encodes them. Frames are dropped when the process cannot keep up, so
+    recording never slows the live stream down. Camera videos are recorded at `resolution` ("WxH"), or
+    that of their first frame; frames of another size (e.g. thumbnails of unfocused cameras) are scaled to it.
+    """
+
+    def __init__(
+        self, capturer: FrameCapturer, keys: list, out_dir: Path, mosaic: bool = False, resolution: Optional[str] = None
+    ):
+        self.capturer = capturer
+        self.key = f"recorder:{out_dir}"  # key for the capturer
+        self.keys = keys
+        self.out_dir = out_dir
+        self.num_recorded = 0
+        self.num_dropped = 0  # frames not recorded because the recording process was busy
+
+        out_dir.mkdir(parents=True, exist_ok=True)
+        ctx = mp.get_context("spawn")
+        self.queue = ctx.Queue(maxsize=max_queued_frames)
+        self.process = ctx.Process(
+            target=_record_worker, args=(self.queue, str(out_dir), keys, mosaic, resolution), daemon=True
+        )
+        self.process.start()
+        self.capturer.set_demand(self.key, keys)  # keep rendering the cameras even if nobody watches
+        self.task = asyncio.create_task(self.run())
+        print(f"Recording {len(keys)} camera(s) to {out_dir}")
+
+    async def run(self):
+        last = self.capturer.latest
+        last_recorded_time = 0.0
+        while True:
+            captured = await self.capturer.wait_frame(last.seq)
+            last = captured
+            if captured.capture_time - last_recorded_time < 1 / recording_fps - 1e-3:
+                continue
+            visuals = {key: captured.visuals[key] for key in self.keys if key in captured.visuals}
+            if len(visuals) == 0:
+                continue
+            try:
+                self.queue.put_nowait((captured.capture_time, visuals))
+                self.num_recorded += 1
+            except queue.Full:
+                self.num_dropped += 1
+            last_recorded_time = captured.capture_time
+
+    async def stop(self):
+        self.capturer.set_demand(self.key, None)
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(None, self.queue.put, None, True, stop_timeout_sec)
+            await loop.run_in_executor(None, self.process.join, stop_timeout_sec)
+        except queue.Full:
+            pass
+        if self.process.is_alive():
+            print(f"Recording process for {self.out_dir} did not finish, terminating")
+            self.process.terminate()
+        print(f"Recording to {self.out_dir} stopped ({self.num_recorded} frames, {self.num_dropped} dropped)")
+
+
+def _video_name(key: str) -> str:
+    # e.g. "rgb:franka0_front_cam:256x256:2d" -> "franka0_front_cam"
+    return key.split(":")[1]
+
+
+def _record_worker(frame_queue, out_dir, keys, mosaic, resolution):
+    import av  # only needed in the recording process
+
+    names = ["mosaic"] if mosaic else [_video_name(key) for key in keys]
+    cols, rows = mosaic_layout(len(keys))
+    containers = {}
+    streams = {}
+    buffers = None
+    start_time = None
+    last_pts = -1
+
+    try:
+        while True:
+            item = frame_queue.get()
+            if item is None:
+                break
+            capture_time, visuals = item
+            if mosaic:
+                if not all(key in visuals for key in keys):
+                    continue
+                planes = [yuv420p_planes(visuals[key]) for key in keys]
+                h, w = planes[0][0].shape
+                if buffers is None or buffers[0].shape != (rows * h, cols * w):
+                    buffers = [
+                        np.zeros((rows * h, cols * w), dtype=np.uint8),
+                        np.full((rows * h // 2, cols * w // 2), 128, dtype=np.uint8),
+                        np.full((rows * h // 2, cols * w // 2), 128, dtype=np.uint8),
+                    ]
+                for i, buffer in enumerate(buffers):
+                    tile_frames(buffer, [p[i] for p in planes], cols)
+                images = {"mosaic": np.concatenate([b.reshape(-1) for b in buffers]).reshape(-1, cols * w)}
+            else:
+                images = {_video_name(key): visuals[key] for key in keys if key in visuals}
+
+            if start_time is None:
+                start_time = capture_time
+            # timestamps follow the capture so that dropped frames do not speed the video up
+            pts = round((capture_time - start_time) * recording_fps)
+            if pts <= last_pts:
+                continue
+            last_pts = pts
+
+            for name, image in images.items():
+                frame = av.VideoFrame.from_ndarray(image, format="yuv420p")
+                if name not in containers:
+                    containers[name] = av.open(str(Path(out_dir) / f"{name}.mp4"), mode="w")
+                    stream = containers[name].add_stream("libx264", rate=recording_fps)
+                    if resolution is not None and not mosaic:
+                        stream.width, stream.height = map(int, resolution.split("x"))
+                    else:
+                        stream.width = frame.width
+                        stream.height = frame.height
+                    stream.pix_fmt = "yuv420p"
+                    stream.bit_rate = recording_bitrate
+                    stream.codec_context.time_base = fractions.Fraction(1, recording_fps)
+                    stream.options = {"preset": "veryfast"}
+                    streams[name] = stream
+                stream = streams[name]
+                if (frame.width, frame.height) != (stream.width, stream.height):
+                    # cameras change resolution with the focus of the users
+                    frame = frame.reformat(stream.width, stream.height)
+                frame.pts = pts
+                containers[name].mux(stream.encode(frame))
+    finally:
+        for name, container in containers.items():
+            container.mux(streams[name].encode())  # flush
+            container.close()
+        print(f"Recorded {', '.join(names)} to {out_dir} in {time.process_time():.1f} s of CPU")
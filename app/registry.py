@@ -0,0 +1,173 @@
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Set
+
+from app.utils.ratelimit import TokenBucket
+
+browser_ttl_sec = 12 * 3600  # browsers without a live socket are forgotten after this time without activity
+
+
+@dataclass
+class BrowserSession:
+    unique_user_id: str  # from the browser cookie
+    username: Optional[str] = None
+    connected: bool = False
+    current_mode: Optional[str] = None  # page last opened
+    current_sid: Optional[str] = None  # socket of the task page, if any
+    current_instance: Optional[str] = None  # env instance of the task page
+    last_seen: float = 0.0
+
+
+@dataclass
+class ClientSession:
+    sid: str
+    user_id: str  # random id generated for each socket connection
+    instance_id: str  # env instance the client is placed on
+    username: Optional[str] = None  # set with the WebRTC offer request
+    focus_id: Optional[int] = None  # robot focused by the client
+    setup_time: Optional[float] = None  # seconds from the offer request to the first video packet
+    unique_user_id: Optional[str] = None  # browser of the client
+    command_bucket: Optional[TokenBucket] = None  # rate limit of the commands
+    pending_command: Optional[dict] = None  # latest command over the rate limit, handled once allowed
+
+
+class SessionRegistry:
+    """Browsers and socket.io clients, indexed by sid, browser id, username and env instance.
+
+    All lookups are dict accesses so that the cost of each event does not grow with the number
+    of users seen by the server. Browsers that are not connected anymore are evicted after
+    `browser_ttl_sec`.
+    """
+
+    def __init__(self, ttl_sec: float = browser_ttl_sec):
+        self.ttl_sec = ttl_sec
+        self.browsers: "OrderedDict[str, BrowserSession]" = OrderedDict()  # least recently seen first
+        self.clients: Dict[str, ClientSession] = {}
+        self._browsers_by_username: Dict[str, Set[str]] = {}
+        self._browsers_by_instance: Dict[str, Set[str]] = {}
+        self._clients_by_instance: Dict[str, Set[str]] = {}
+        self._client_by_username: Dict[str, str] = {}
+        self.changed_instances: Set[str] = set()  # instances whose list of connected users may have changed
+
+    # browsers
+
+    def touch_browser(self, unique_user_id: str) -> BrowserSession:
+        """Return the browser, created if unknown, and mark it as seen."""
+        self.evict_stale()
+        browser = self.browsers.get(unique_user_id)
+        if browser is None:
+            browser = BrowserSession(unique_user_id)
+            self.browsers[unique_user_id] = browser
+        browser.last_seen = time.time()
+        self.browsers.move_to_end(unique_user_id)
+        return browser
+
+    def get_browser(self, unique_user_id: str) -> Optional[BrowserSession]:
+        return self.browsers.get(unique_user_id)
+
+    def set_username(self, browser: BrowserSession, username: Optional[str]):
+        if username == browser.username:
+            return
+        _discard(self._browsers_by_username, browser.username, browser.unique_user_id)
+        browser.username = username
+        _add(self._browsers_by_username, username, browser.unique_user_id)
+        self._mark_changed(browser.current_instance)
+
+    def set_connected(self, browser: BrowserSession, connected: bool):
+        if connected == browser.connected:
+            return
+        browser.connected = connected
+        self._mark_changed(browser.current_instance)
+
+    def set_instance(self, browser: BrowserSession, instance_id: Optional[str]):
+        if instance_id == browser.current_instance:
+            return
+        _discard(self._browsers_by_instance, browser.current_instance, browser.unique_user_id)
+        self._mark_changed(browser.current_instance)
+        browser.current_instance = instance_id
+        _add(self._browsers_by_instance, instance_id, browser.unique_user_id)
+        self._mark_changed(instance_id)
+
+    def _mark_changed(self, instance_id: Optional[str]):
+        if instance_id is not None:
+            self.changed_instances.add(instance_id)
+
+    def pop_changed_instances(self) -> Set[str]:
+        changed, self.changed_instances = self.changed_instances, set()
+        return changed
+
+    def is_username_connected(self, username: str) -> bool:
+        return any(self.browsers[uid].connected for uid in self._browsers_by_username.get(username, ()))
+
+    def get_connected_usernames(self, instance_id: str) -> List[str]:
+        usernames = []
+        for uid in self._browsers_by_instance.get(instance_id, ()):
+            browser = self.browsers[uid]
+            if browser.connected and browser.username:
+                usernames.append(browser.username)
+        return usernames
+
+    def evict_stale(self):
+        now = time.time()
+        while len(self.browsers) > 0:
+            uid, browser = next(iter(self.browsers.items()))
+            if now - browser.last_seen < self.ttl_sec:
+                break
+            if browser.current_sid in self.clients:
+                # still has a live socket; check again after another TTL
+                browser.last_seen = now
+                self.browsers.move_to_end(uid)
+                continue
+            del self.browsers[uid]
+            _discard(self._browsers_by_username, browser.username, uid)
+            _discard(self._browsers_by_instance, browser.current_instance, uid)
+            self._mark_changed(browser.current_instance)
+
+    # socket.io clients
+
+    def add_client(self, sid: str, user_id: str, instance_id: str) -> ClientSession:
+        client = ClientSession(sid, user_id, instance_id)
+        self.clients[sid] = client
+        _add(self._clients_by_instance, instance_id, sid)
+        return client
+
+    def remove_client(self, sid: str) -> Optional[ClientSession]:
+        client = self.clients.pop(sid, None)
+        if client is not None:
+            _discard(self._clients_by_instance, client.instance_id, sid)
+            if self._client_by_username.get(client.username) == sid:
+                del self._client_by_username[client.username]
+        return client
+
+    def get_client(self, sid: str) -> Optional[ClientSession]:
+        return self.clients.get(sid)
+
+    def set_client_username(self, client: ClientSession, username: str):
+        # a username is used by a single client; the latest one wins (e.g. after a reload)
+        previous_sid = self._client_by_username.get(username)
+        if previous_sid is not None and previous_sid != client.sid and previous_sid in self.clients:
+            self.clients[previous_sid].username = None
+        if self._client_by_username.get(client.username) == client.sid:
+            del self._client_by_username[client.username]
+        client.username = username
+        self._client_by_username[username] = client.sid
+
+    def get_client_by_username(self, username: str) -> Optional[ClientSession]:
+        sid = self._client_by_username.get(username)
+        return self.clients.get(sid) if sid is not None else None
+
+    def get_clients(self, instance_id: str) -> List[ClientSession]:
+        return [self.clients[sid] for sid in self._clients_by_instance.get(instance_id, ())]
+
+
+def _add(index: Dict[str, Set[str]], key: Optional[str], value: str):
+    if key is not None:
+        index.setdefault(key, set()).add(value)
+
+
+def _discard(index: Dict[str, Set[str]], key: Optional[str], value: str):
+    if key is not None and key in index:
+        index[key].discard(value)
+        if len(index[key]) == 0:
+            del index[key]
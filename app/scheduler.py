@@ -0,0 +1,105 @@
+import os
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+
+@dataclass
+class EnvInstance:
+    instance_id: str
+    mode: str
+    num_workers: int  # number of sub env processes used by the instance
+    num_clients: int = 0
+    is_running: bool = False
+
+
+class EnvScheduler:
+    """Places groups of clients on concurrent env instances of each mode.
+
+    Clients opening a mode join the instance of that mode that is still gathering participants
+    (i.e. not running). Once an experiment starts, new clients are placed on a fresh instance
+    as long as enough CPU cores are free for its sub env worker processes.
+    """
+
+    def __init__(self, env_info: dict, max_workers: Optional[int] = None, use_sub_envs: bool = True):
+        self.env_info = env_info
+        self.use_sub_envs = use_sub_envs  # False with the stand-in env of load tests
+        if max_workers is None:
+            max_workers = int(os.getenv("MAX_ENV_WORKERS", _num_available_cores()))
+        self.max_workers = max_workers  # total number of sub env processes allowed on this server
+
+        self.instances: Dict[str, EnvInstance] = {}
+        self._counters: Dict[str, int] = {}  # number of instances created for each mode
+
+    def num_workers(self, mode: str) -> int:
+        if self.env_info[mode].get("prerendered", False) or not self.use_sub_envs:
+            return 0  # served from cached frames without simulation
+        # EnvRunner runs one sub env process per agent
+        return self.env_info[mode]["num_agents"]
+
+    @property
+    def num_free_workers(self) -> int:
+        return self.max_workers - sum(inst.num_workers for inst in self.instances.values())
+
+    def has_capacity(self, mode: str) -> bool:
+        # always allow at least one instance so that the server is usable on small machines
+        return len(self.instances) == 0 or self.num_workers(mode) <= self.num_free_workers
+
+    def _find_open_instance(self, mode: str) -> Optional[EnvInstance]:
+        # prefer the instance gathering the largest group so that participants end up together
+        candidates = [
+            inst
+            for inst in self.instances.values()
+            if inst.mode == mode and not inst.is_running and not inst.instance_id.startswith("data-collection")
+        ]
+        if len(candidates) == 0:
+            return None
+        return max(candidates, key=lambda inst: inst.num_clients)
+
+    def can_admit(self, mode: str) -> bool:
+        """Return True if a client opening `mode` can be placed on an instance."""
+        if self._find_open_instance(mode) is not None:
+            return True
+        return self.has_capacity(mode)
+
+    def assign(self, mode: str, instance_id: Optional[str] = None) -> Optional[str]:
+        """Place a client on an instance of `mode` and return its id, or None if the server is full.
+
+        If `instance_id` is given, a private instance with this id is created (e.g. for data collection).
+        """
+        inst = None
+        if instance_id is None:
+            inst = self._find_open_instance(mode)
+        if inst is None:
+            if not self.has_capacity(mode):
+                return None
+            if instance_id is None:
+                instance_id = f"{mode}.{self._counters.get(mode, 0)}"
+                self._counters[mode] = self._counters.get(mode, 0) + 1
+            inst = EnvInstance(instance_id, mode, self.num_workers(mode))
+            self.instances[instance_id] = inst
+            print(f"Instance {instance_id} created ({self.num_free_workers} free workers left)")
+        inst.num_clients += 1
+        return inst.instance_id
+
+    def leave(self, instance_id: str) -> bool:
+        """Remove a client from the instance. Return True if the instance has no client left."""
+        inst = self.instances[instance_id]
+        inst.num_clients -= 1
+        return inst.num_clients <= 0
+
+    def release(self, instance_id: str):
+        if instance_id in self.instances:
+            del self.instances[instance_id]
+            print(f"Instance {instance_id} released ({self.num_free_workers} free workers left)")
+
+    def set_running(self, instance_id: str, is_running: bool):
+        self.instances[instance_id].is_running = is_running
+
+    def get_mode(self, instance_id: str) -> str:
+        return self.instances[instance_id].mode
+
+
+def _num_available_cores() -> int:
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
@@ -0,0 +1,71 @@
+"""Compare per-camera tracks with a single mosaic track.
+
+Measures the CPU time to encode one second of video and the time for the server to create
+an offer (createOffer + setLocalDescription) for the given number of cameras.
+
+Usage:
+    python -m app.scripts.bench_stream -n 16
+"""
+
+import asyncio
+import time
+
+import click
+import numpy as np
+from aiortc import RTCPeerConnection
+from av import VideoFrame
+
+from app.stream import _create_h264_codec, fps, mosaic_layout, tile_frames
+
+
+def _make_images(num_cameras, size, t):
+    # moving gradients so that the encoder has some work to do
+    x = np.arange(size, dtype=np.uint8)
+    return [np.stack(np.meshgrid(x + i + t, x + 2 * t, indexing="ij") + [np.full((size, size), i * 10, np.uint8)], -1)
+            for i in range(num_cameras)]
+
+
+def bench_encode(num_cameras, size, mosaic):
+    cols, rows = mosaic_layout(num_cameras)
+    codecs = [_create_h264_codec(cols * size, rows * size)] if mosaic else \
+        [_create_h264_codec(size, size) for _ in range(num_cameras)]
+    buffer = np.zeros((rows * size, cols * size, 3), dtype=np.uint8)
+
+    cpu_time = 0.0
+    for t in range(fps):
+        images = _make_images(num_cameras, size, t)
+        start = time.process_time()
+        if mosaic:
+            tile_frames(buffer, images, cols)
+            images = [buffer]
+        for codec, image in zip(codecs, images):
+            codec.encode(VideoFrame.from_ndarray(image, format="rgb24").reformat(format="yuv420p"))
+        cpu_time += time.process_time() - start
+    return cpu_time
+
+
+async def bench_negotiation(num_tracks):
+    pc = RTCPeerConnection()
+    for _ in range(num_tracks):
+        pc.addTransceiver("video", direction="sendonly")
+    start = time.time()
+    offer = await pc.createOffer()
+    await pc.setLocalDescription(offer)
+    elapsed = time.time() - start
+    await pc.close()
+    return elapsed
+
+
+@click.command()
+@click.option("-n", "--num-cameras", default=16, help="Number of robot cameras")
+@click.option("-s", "--size", default=256, help="Camera resolution")
+def main(num_cameras, size):
+    for name, mosaic, num_tracks in [("per-camera", False, num_cameras), ("mosaic", True, 1)]:
+        cpu_time = bench_encode(num_cameras, size, mosaic)
+        negotiation_time = asyncio.run(bench_negotiation(num_tracks))
+        print(f"{name:>10}: encode CPU {cpu_time:.3f} s per second of video, "
+              f"offer {negotiation_time:.3f} s for {num_tracks} track(s)")
+
+
+if __name__ == "__main__":
+    main()
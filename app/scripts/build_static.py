@@ -0,0 +1,71 @@
+"""Build the static assets for production.
+
+Copies each file of app/static under a name containing a hash of its content (e.g.
+app.3f9c0a1b2d.js), with gzip and brotli variants of the text files, and writes the mapping to
+manifest.json. The server serves them when the manifest exists (see app/utils/static.py); run this
+again after changing app/static.
+
+Usage:
+    python -m app.scripts.build_static
+"""
+
+import gzip
+import hashlib
+import json
+import shutil
+from pathlib import Path
+
+import brotli
+import click
+
+from app.utils.static import manifest_name
+
+app_dir = Path(__file__).parents[1]
+compressible_suffixes = {".js", ".css", ".svg", ".json", ".html", ".txt"}  # images are compressed already
+
+
+def hashed_name(path: Path, content: bytes) -> str:
+    digest = hashlib.sha256(content).hexdigest()[:10]
+    return f"{path.stem}.{digest}{path.suffix}"
+
+
+@click.command()
+@click.option("--src", default=str(app_dir / "static"), help="Directory of the assets")
+@click.option("--out", default=str(app_dir / "static_build"), help="Output directory, replaced")
+def main(src, out):
+    src, out = Path(src), Path(out)
+    if out.exists():
+        shutil.rmtree(out)
+    manifest = {}
+    size = 0  # of the text assets before compression
+    compressed_sizes = {".gz": 0, ".br": 0}
+    for path in sorted(p for p in src.rglob("*") if p.is_file()):
+        content = path.read_bytes()
+        rel_path = path.relative_to(src)
+        out_rel_path = rel_path.with_name(hashed_name(rel_path, content))
+        out_path = out / out_rel_path
+        out_path.parent.mkdir(parents=True, exist_ok=True)
+        out_path.write_bytes(content)
+        manifest[rel_path.as_posix()] = out_rel_path.as_posix()
+
+        if path.suffix not in compressible_suffixes:
+            continue
+        size += len(content)
+        for suffix, compressed in [
+            (".gz", gzip.compress(content, compresslevel=9, mtime=0)),
+            (".br", brotli.compress(content, quality=11)),
+        ]:
+            if len(compressed) < len(content):  # otherwise the plain file is served
+                Path(f"{out_path}{suffix}").write_bytes(compressed)
+            compressed_sizes[suffix] += min(len(compressed), len(content))
+
+    (out / manifest_name).write_text(json.dumps(manifest, indent=2))
+    print(f"Built {len(manifest)} assets in {out}")
+    print(
+        f"Text assets: {size / 1024:.0f} KiB, gzip {compressed_sizes['.gz'] / 1024:.0f} KiB, "
+        f"brotli {compressed_sizes['.br'] / 1024:.0f} KiB"
+    )
+
+
+if __name__ == "__main__":
+    main()
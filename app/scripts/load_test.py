@@ -0,0 +1,159 @@
+"""Load test of the server with synthetic participants.
+
+Each participant opens a socket.io connection like the task page does (cookie and endpoint query),
+joins the session (requestServerStart / addUser) and sends commands at random times, like a BCI
+decoder would. Reports the latency from a command to its broadcast, and the event loop lag, CPU
+usage and env tick rate of the server.
+
+Run the server with the stand-in env, which needs no simulation, then the load test:
+    BENCHMARK_ENV=1 python -m app.main
+    python -m app.scripts.load_test -m multi-robot-4 -m multi-robot-16 -n 8 --rate 0.5
+"""
+
+import random
+import threading
+import time
+import uuid
+
+import click
+import numpy as np
+import requests
+import socketio
+import urllib3
+
+from app.utils.wire import event_fields, pack, request_fields, unpack
+
+urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)  # self-signed certificate of the server
+
+
+class Participant:
+    def __init__(self, url: str, mode: str, name: str, rate: float, webrtc: bool, joined: threading.Barrier):
+        self.url = url
+        self.mode = mode
+        self.name = name
+        self.rate = rate  # commands per second
+        self.webrtc = webrtc
+        self.joined = joined  # participants of the mode, so that they join the same instance before it starts
+
+        self.sio = socketio.Client(ssl_verify=False, reconnection=False)
+        self.started = threading.Event()
+        self.command_labels = []
+        self.num_agents = 0
+        self.wire_format = "json"
+        self.sent_times = {}  # send time of each command, by its likelihoods
+        self.latencies = []
+        self.num_sent = 0
+        self.lock = threading.Lock()
+
+        self.sio.on("init", self._on_init)
+        self.sio.on("requestClientStart", self._on_client_start)
+        self.sio.on("serverStartDone", lambda *args: self.started.set())
+        self.sio.on("command", self._on_command)
+
+    def _on_init(self, data):
+        self.command_labels = data["commandLabels"]
+        self.num_agents = data["numAgents"]
+        self.wire_format = data.get("wireFormat", "json")
+
+    def _on_client_start(self, *args):
+        userinfo = {"name": self.name, "age": 30, "gender": "other", "language": "en"}
+        self.sio.emit("addUser", {"userinfo": userinfo, "deviceSelection": {"keyboard": True}})
+
+    def _on_command(self, payload):
+        data = unpack(event_fields["command"], payload) if isinstance(payload, bytes) else payload
+        likelihoods = data.get("likelihoods")
+        if likelihoods is None:
+            return
+        with self.lock:
+            sent_time = self.sent_times.pop(tuple(likelihoods), None)
+        if sent_time is not None:
+            self.latencies.append(time.time() - sent_time)
+
+    def run(self, stop: threading.Event):
+        cookie = f"unique_user_id={uuid.uuid4()}"
+        self.sio.connect(f"{self.url}?endpoint=/{self.mode}", headers={"Cookie": cookie}, transports=["websocket"])
+        if self.webrtc:
+            # the offer is not answered; this only measures the server side of the signaling
+            self.sio.emit("webrtc-offer-request", {"name": self.name})
+        if self.joined.wait() == 0:
+            self.sio.emit("requestServerStart")  # one participant starts the session for the group
+        self.started.wait()
+
+        while not stop.is_set():
+            stop.wait(random.expovariate(self.rate))
+            if stop.is_set() or not self.sio.connected:
+                break
+            likelihoods = np.random.dirichlet(np.ones(len(self.command_labels))).tolist()
+            command = self.command_labels[int(np.argmax(likelihoods))]
+            with self.lock:
+                self.sent_times[tuple(likelihoods)] = time.time()
+            data = {
+                "agentId": random.randrange(self.num_agents),
+                "command": command,
+                "likelihoods": likelihoods,
+                "interactionTime": random.uniform(0.5, 3.0),
+            }
+            self.sio.emit("command", pack(request_fields["command"], data) if self.wire_format == "msgpack" else data)
+            self.num_sent += 1
+        self.sio.disconnect()
+
+
+def poll_server_stats(url: str, stop: threading.Event, samples: list, interval: float = 1.0):
+    while not stop.wait(interval):
+        try:
+            samples.append(requests.get(f"{url}/api/benchmark-stats", verify=False, timeout=5).json())
+        except requests.RequestException as e:
+            print(f"Failed to get the server stats: {e}")
+
+
+def report(participants: list, samples: list):
+    latencies = np.array([latency for p in participants for latency in p.latencies]) * 1000
+    num_sent = sum(p.num_sent for p in participants)
+    print(f"commands: {num_sent} sent, {len(latencies)} broadcasts received")
+    if len(latencies) > 0:
+        p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+        print(f"command -> broadcast latency: p50 {p50:.1f} ms, p90 {p90:.1f} ms, p99 {p99:.1f} ms, "
+              f"max {latencies.max():.1f} ms")
+    if len(samples) < 2:
+        return
+    first, last = samples[0], samples[-1]
+    elapsed = last["time"] - first["time"]
+    print(f"server CPU: {100 * (last['cpuTime'] - first['cpuTime']) / elapsed:.0f} % of a core")
+    lags = np.array([s["maxLoopLag"] for s in samples[1:]]) * 1000
+    print(f"event loop lag (max per second): p50 {np.median(lags):.1f} ms, max {lags.max():.1f} ms")
+    for mode, ticks in last["envTicks"].items():
+        if mode in first["envTicks"]:
+            rate = (ticks - first["envTicks"][mode]) / elapsed
+            print(f"env tick rate of {mode}: {rate:.1f} Hz (target {last['targetTickRate']:.1f} Hz)")
+
+
+@click.command()
+@click.option("--url", default="https://localhost:8000", help="URL of the server")
+@click.option("-m", "--mode", "modes", multiple=True, default=["multi-robot-4"], help="Modes to load")
+@click.option("-n", "--num-clients", default=4, help="Participants per mode")
+@click.option("--rate", default=0.5, help="Commands per second per participant")
+@click.option("--duration", default=30.0, help="Duration of the test in seconds")
+@click.option("--webrtc", is_flag=True, help="Also request WebRTC offers")
+def main(url, modes, num_clients, rate, duration, webrtc):
+    barriers = {mode: threading.Barrier(num_clients) for mode in modes}
+    participants = [
+        Participant(url, mode, f"load-{mode}-{i}", rate, webrtc, barriers[mode])
+        for mode in modes
+        for i in range(num_clients)
+    ]
+    stop = threading.Event()
+    threads = [threading.Thread(target=p.run, args=(stop,), daemon=True) for p in participants]
+    samples = []
+    threads.append(threading.Thread(target=poll_server_stats, args=(url, stop, samples), daemon=True))
+    for thread in threads:
+        thread.start()
+
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join(timeout=5)
+    report(participants, samples)
+
+
+if __name__ == "__main__":
+    main()
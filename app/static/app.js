@@ -8,7 +8,9 @@ import { init as initKeyboard } from './keyboard.js';
 import { init as initMouse } from './mouse.js';
 import { binStr2Rgba, disconnectUser, getCookie } from './utils.js';
 import { handleOffer, handleRemoteIce, setupPeerConnection } from './webrtc.js';
+import { startImageStream } from './image-stream.js';
 import { applyLocalization, initUILanguage } from './localization.js';
+import { decodeEvent, encodeRequest } from './wire.js';
 
 const robotSelectionDeviceInitFuncs = {
     mouse: initMouse,
@@ -20,7 +22,9 @@ const subtaskSelectionDeviceInitFuncs = {
     eeg: initEEG,
 };
 
-let sockEnv, userinfo, commandLabels, commandColors;
+let sockEnv, userinfo, commandLabels, commandColors, mosaicLayout;
+let wireFormat = 'json';  // encoding of the high-rate events, chosen by the server
+const webrtcTimeoutMs = 15000;  // fall back to images if no video plays by then
 let isStarted = false;  // if true, task is started and accepting subtask selection
 let isDataCollection = false;
 
@@ -190,24 +194,38 @@ const connectEnv = () => {
     // - WebRTC signaling
     // - focus update notification
     console.log(location.pathname)
-    sockEnv = io.connect(`${location.protocol}//${location.hostname}:8000`, {
+    // the page is served by the server process owning the mode (see app/cluster.py)
+    sockEnv = io.connect(`${location.protocol}//${location.host}`, {
         transports: ['websocket'],
         query: { endpoint: location.pathname },
     });
     let pc;
+    let usesImageStream = false;
+    const fallbackToImages = () => {
+        if (usesImageStream) return;
+        usesImageStream = true;
+        updateLog("WebRTC failed, receiving video as images");
+        if (pc) pc.close();
+        startImageStream(sockEnv, document.querySelectorAll('video'), () => createCharts(commandColors, commandLabels));
+    };
 
     sockEnv.on('connect', () => {
         updateLog("Env server connected");
         // request WebRTC offer to the server
         sockEnv.emit('webrtc-offer-request', userinfo);
+        // on restrictive networks ICE may neither succeed nor fail for a long time
+        const fallbackTimer = setTimeout(fallbackToImages, webrtcTimeoutMs);
+        document.querySelector('video').addEventListener('playing', () => clearTimeout(fallbackTimer), { once: true });
     });
     
     sockEnv.on('status', (message) => {
         updateTaskStatusMsg(message);
         updateLog(`Server: ${message}`);
     });
-    sockEnv.on('init', ({ expId, isDataCollection: idc, commandLabels: labels, commandColors: colors }) => {
+    sockEnv.on('init', ({ expId, isDataCollection: idc, commandLabels: labels, commandColors: colors, mosaicLayout: layout, wireFormat: format }) => {
         isDataCollection = idc;
+        wireFormat = format ?? 'json';
+        mosaicLayout = layout;  // null if each camera has its own track
         // commandColors: ["001", "010", ...]
         commandColors = colors.map(c => binStr2Rgba(c, 0.3));
         commandLabels = labels;
@@ -222,13 +240,16 @@ const connectEnv = () => {
             if (deviceSelection[device]) robotSelectionDeviceInitFuncs[device]();
         });
         Object.keys(subtaskSelectionDeviceInitFuncs).forEach(device => {
-            if (deviceSelection[device]) subtaskSelectionDeviceInitFuncs[device](onSubtaskSelectionEvent, commandLabels, userinfo.name, expId);
+            if (deviceSelection[device]) subtaskSelectionDeviceInitFuncs[device](onSubtaskSelectionEvent, commandLabels, userinfo.name, expId, wireFormat);
         });
 
         // Share userinfo across the session, for other modules to use
         sessionStorage.setItem("userinfo", JSON.stringify(userinfo));
+        // The server may run several instances of this mode, so keep the expId to link the survey to it
+        sessionStorage.setItem("expId", expId);
     });
-    sockEnv.on('command', ({ agentId, command, nextAcceptableCommands, isNowAcceptable, hasSubtaskNotDone, likelihoods, interactionTime, username}) => {
+    sockEnv.on('command', (payload) => {
+        const { agentId, command, nextAcceptableCommands, isNowAcceptable, hasSubtaskNotDone, likelihoods, interactionTime, username } = decodeEvent('command', payload);
         if (interactionTime) {
             updateLog(`Agent ${agentId}: Interaction time ${interactionTime.toFixed(1)}s`);
         }
@@ -256,13 +277,17 @@ const connectEnv = () => {
     sockEnv.on('requestClientStart', clientStart);
     sockEnv.on('serverStartDone', onServerStartDone);
     sockEnv.on('requestClientStop', clientStop);
-    sockEnv.on('subtaskDone', ({ agentId, subtask }) => {  // TODO: subtaskCompleted
+    sockEnv.on('persistenceStatus', ({ expId, saved }) => {
+        updateLog(saved ? `Session ${expId}: results saved` : `Session ${expId}: failed to save the results`);
+    });
+    sockEnv.on('subtaskDone', (payload) => {  // TODO: subtaskCompleted
+        const { agentId, subtask } = decodeEvent('subtaskDone', payload);
         updateLog(`Agent ${agentId}: Subtask "${subtask}" done`);
         if (getFocusId() === agentId) resetInteractionTimer();  // reset the timer if the agent is selected so that the time during the subtask is not counted
     });
     sockEnv.on('webrtc-offer', async (data) => {
         console.log("WebRTC offer received");
-        pc = setupPeerConnection(sockEnv, document.querySelectorAll('video'));
+        pc = setupPeerConnection(sockEnv, document.querySelectorAll('video'), mosaicLayout, fallbackToImages);
         await handleOffer(sockEnv, pc, data);
     });
     sockEnv.on('webrtc-ice', async (data) => {
@@ -334,13 +359,13 @@ const onSubtaskSelectionEvent = (command, likelihoods = undefined) => {
         const interactionTime = getInteractionTime();
         resetInteractionTimer();
 
-        sockEnv.emit('command', {
+        // the user is known to the server from the offer request, so userinfo is not sent with each command
+        sockEnv.emit('command', encodeRequest('command', {
             agentId: agentId,
             command: commandLabel,
             likelihoods: likelihoods,
             interactionTime: interactionTime,
-            userinfo: userinfo,
-        });
+        }, wireFormat));
     }
     // update the chart
     updateChartData(agentId, likelihoods);
@@ -40,7 +40,8 @@ export const updateCursorAndFocus = (x, y, isDelta = false) => {
     // TODO: optimize this process
     let newId = null;
     for (const [i, video] of videos.entries()) {
-        const rect = video.getBoundingClientRect();
+        // use the container since the video is larger than its tile in the mosaic layout
+        const rect = video.parentElement.getBoundingClientRect();
         if (x >= rect.left && x <= rect.right && y >= rect.top && y <= rect.bottom) {
             newId = i;
             break;
@@ -52,21 +53,17 @@ export const updateCursorAndFocus = (x, y, isDelta = false) => {
 const _updateAndNotifyFocus = (newId) => {
     // remove border of the previous focused image
     if (focusId != null) {
-        videos[focusId].style.border = "2px solid transparent";
+        videos[focusId].parentElement.style.borderColor = "transparent";
     }
     // set border to the new focused image
     if (newId != null) {
-        videos[newId].style.border = "2px solid red";
+        videos[newId].parentElement.style.borderColor = "red";
     }
     // update focusId
     focusId = newId;
 
-    // notify focusId to the server
-    // if (sockEnv === undefined) {
-    //     console.error("sockEnv is not set. Call setSockEnv first.")
-    //     return;
-    // }
-    // if (sockEnv.connected) sockEnv.emit('focus', focusId);
+    // notify focusId to the server, which renders the focused camera in high resolution
+    if (sockEnv !== undefined && sockEnv.connected) sockEnv.emit('focus', focusId);
 
     // start the timer
     resetInteractionTimer();
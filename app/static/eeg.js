@@ -1,11 +1,12 @@
 import { updateDeviceStatus } from './utils.js';
+import { decodeEvent } from './wire.js';
 
 const deviceName = 'EEG/EMG';
 const eventName = 'eeg';
 const port = 8002;
 let sock;
 
-export const init = (commandHandler, commandLabels, userId, expId) => {
+export const init = (commandHandler, commandLabels, userId, expId, wireFormat = 'json') => {
     updateDeviceStatus(deviceName, 'connecting...');
     sock = io.connect(`http://localhost:${port}`, { transports: ['websocket'] });
 
@@ -14,6 +15,7 @@ export const init = (commandHandler, commandLabels, userId, expId) => {
             commandLabels: commandLabels,
             userId: userId,
             expId: expId,
+            wireFormat: wireFormat,  // encoding of the likelihoods sent back
         });
         updateDeviceStatus(deviceName, 'connected');
         console.log("EEG server connected");
@@ -26,7 +28,10 @@ export const init = (commandHandler, commandLabels, userId, expId) => {
         updateDeviceStatus(deviceName, 'reconnecting...');
         console.log("EEG server reconnecting...");
     });
-    sock.on(eventName, ({ classId, likelihoods }) => commandHandler(classId, likelihoods));
+    sock.on(eventName, (payload) => {
+        const { classId, likelihoods } = decodeEvent(eventName, payload);
+        commandHandler(classId, likelihoods);
+    });
     sock.on('ping', (ack) => ack());
     sock.on('getTime', (ack) => ack(Date.now()));
 }
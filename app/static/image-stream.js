@@ -0,0 +1,32 @@
+// Fallback when WebRTC cannot be established: the server sends the cameras as images over socket.io
+export const startImageStream = (socket, videos, onFirstImage) => {
+    // show an image in place of each video; the container keeps the layout and the focus border
+    const images = [...videos].map(video => {
+        const img = document.createElement('img');
+        img.className = 'camera-image';
+        video.parentElement.classList.remove('mosaic-tile');
+        video.style.display = 'none';
+        video.parentElement.appendChild(img);
+        return img;
+    });
+    let isFirst = true;
+
+    socket.on('frame', ({ camera, format, image }, ack) => {
+        const img = images[camera];
+        const url = URL.createObjectURL(new Blob([image], { type: `image/${format}` }));
+        img.onload = () => {
+            URL.revokeObjectURL(url);
+            ack();  // the server sends the next image of this camera only once this one is shown
+            if (isFirst) {
+                isFirst = false;
+                onFirstImage();
+            }
+        };
+        img.onerror = () => {
+            URL.revokeObjectURL(url);
+            ack();
+        };
+        img.src = url;
+    });
+    socket.emit('image-stream-request');
+}
@@ -110,6 +110,7 @@ const saveNASATLXSurveyData = async () => {
     NASATLXSurveyData["device-selection"] = JSON.parse(sessionStorage.getItem("deviceSelection"));
     NASATLXSurveyData["userinfo"] = JSON.parse(sessionStorage.getItem("userinfo"));
     NASATLXSurveyData["mode"] = mode;
+    NASATLXSurveyData["expId"] = sessionStorage.getItem("expId");
 
     // Send the collected data to the Python backend for saving
     const response = await fetch("/api/save-nasa-tlx-data", {
@@ -1,4 +1,4 @@
-export const setupPeerConnection = (socket, videos) => {
+export const setupPeerConnection = (socket, videos, mosaicLayout = null, onFailed = null) => {
     const pc = new RTCPeerConnection();
     let onTrackCnt = 0;
 
@@ -19,6 +19,12 @@ export const setupPeerConnection = (socket, videos) => {
         // set source of corresponding video element
         const track = event.track;
         console.log(`Track ${onTrackCnt} - readyState: ${track.readyState}, muted: ${track.muted}, id: ${track.id}`);
+        if (mosaicLayout) {
+            // a single track tiles all cameras; every video shows its own tile
+            const stream = new MediaStream([track]);
+            videos.forEach((video, i) => showMosaicTile(video, stream, i, mosaicLayout));
+            return;
+        }
         videos[onTrackCnt].srcObject = new MediaStream([track]);
         onTrackCnt++;
     }
@@ -33,11 +39,24 @@ export const setupPeerConnection = (socket, videos) => {
     }
     pc.oniceconnectionstatechange = (event) => {
         console.log(`ICE connection state: ${pc.iceConnectionState}`);
+        if (pc.iceConnectionState === 'failed' && onFailed) onFailed();
     }
 
     return pc;
 }
 
+const showMosaicTile = (video, stream, idx, { cols, rows }) => {
+    // enlarge the video to the whole mosaic and shift it so that only the tile is visible in the container
+    const row = Math.floor(idx / cols);
+    const col = idx % cols;
+    video.parentElement.classList.add('mosaic-tile');
+    video.style.width = `${cols * 100}%`;
+    video.style.height = `${rows * 100}%`;
+    video.style.left = `${-col * 100}%`;
+    video.style.top = `${-row * 100}%`;
+    video.srcObject = stream;
+}
+
 export const handleOffer = async (socket, pc, data) => {
     if (!pc) {
         console.error('no peerconnection');
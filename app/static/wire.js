@@ -0,0 +1,50 @@
+// Packed encoding of the high-rate socket.io events; mirror of app/utils/wire.py
+// `MessagePack` is loaded from the CDN in app.html
+
+const eventFields = {
+    command: [
+        'agentId',
+        'command',
+        'nextAcceptableCommands',
+        'isNowAcceptable',
+        'hasSubtaskNotDone',
+        'likelihoods',
+        'interactionTime',
+        'username',
+    ],
+    subtaskDone: ['agentId', 'subtask'],
+    eeg: ['classId', 'likelihoods'],
+};
+const requestFields = {
+    command: ['agentId', 'command', 'likelihoods', 'interactionTime'],
+};
+const floatArrayFields = ['likelihoods'];
+
+// payload of an event sent to the server
+export const encodeRequest = (event, data, wireFormat) => {
+    if (wireFormat !== 'msgpack' || !(event in requestFields)) return data;
+    const values = requestFields[event].map(field => {
+        const value = data[field] ?? null;
+        if (floatArrayFields.includes(field) && value !== null) {
+            return new Uint8Array(Float64Array.from(value).buffer);  // little-endian like the server
+        }
+        return value;
+    });
+    return MessagePack.encode(values);
+}
+
+// data of an event received in either wire format
+export const decodeEvent = (event, payload) => {
+    if (!(payload instanceof ArrayBuffer) && !ArrayBuffer.isView(payload)) return payload;
+    const values = MessagePack.decode(payload);
+    const data = {};
+    eventFields[event].forEach((field, i) => {
+        let value = values[i];
+        if (floatArrayFields.includes(field) && value !== null) {
+            // copy since the bytes may not be aligned for a Float64Array view
+            value = Array.from(new Float64Array(value.slice().buffer));
+        }
+        data[field] = value;
+    });
+    return data;
+}
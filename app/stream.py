@@ -1,63 +1,249 @@
 import asyncio
+import fractions
+import io
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple, Optional
 
-from aiortc import VideoStreamTrack
-from aiortc.contrib.media import MediaRelay
+import av
+import numpy as np
+from aiortc import MediaStreamTrack
+from aiortc.mediastreams import VIDEO_TIME_BASE, MediaStreamError
 from av import VideoFrame
+from PIL import Image
+
+from app.utils import telemetry
+from app.utils.video import yuv420p_planes
 
 fps = 30
+# encoding settings a viewer can be switched between, from the best; each camera is encoded once per used level
+quality_levels = [
+    {"scale": 1.0, "fps": 30, "bitrate": 500_000},
+    {"scale": 0.5, "fps": 15, "bitrate": 150_000},
+    {"scale": 0.25, "fps": 10, "bitrate": 60_000},
+]
+adaptation_interval_sec = 2  # interval to read the RTCP stats of each viewer
+max_fraction_lost = 0.1  # above this loss (or rtt), the viewer is switched to a lower level
+max_rtt_sec = 0.4
+upgrade_after = 3  # number of good intervals before switching the viewer to a higher level
+# in multi-robot streams, cameras focused by a user are rendered larger and the others as thumbnails
+focus_resolution = "512x512"
+thumbnail_resolution = "128x128"
+frame_pool_size = 2  # VideoFrames reused by each encoder
+max_queued_packets = 10  # per viewer; a slower viewer waits for the next keyframe
+keyframe_interval_sec = 2  # so that viewers recover from packet loss without PLI
+keepalive_interval_sec = 1  # unchanged frames are only re-sent at this interval
+change_detection_stride = 4  # frames are compared on a subsampled grid
+change_threshold = 2  # max abs pixel difference still considered unchanged (rendering noise)
+# socket.io fallback for clients whose WebRTC connection fails
+image_format = "jpeg"  # or "webp"
+image_quality = 70
+image_fps = 10
+image_workers = 4  # threads compressing the images of all streams
+image_ack_timeout_sec = 2  # an image not acknowledged by then is considered lost
+
+
+def camera_key(camera_idx: int) -> str:
+    return f"rgb:franka{camera_idx}_front_cam:256x256:2d"
+
+
+def mosaic_layout(num_track: int):
+    cols = math.ceil(math.sqrt(num_track))
+    rows = math.ceil(num_track / cols)
+    return cols, rows
+
+
+def tile_frames(buffer: np.ndarray, images: list, cols: int):
+    # copy each camera image into its tile of the preallocated buffer, row-major
+    h, w = images[0].shape[:2]
+    for i, image in enumerate(images):
+        row, col = divmod(i, cols)
+        buffer[row * h:(row + 1) * h, col * w:(col + 1) * w] = image
 
 
 class StreamManager:
     def __init__(self):
         self.capturers = {}
-        self.relays = {}
-        self.base_tracks = {}
-        self.tracks = {}
+        self.num_tracks = {}
+        self.encoders = {}  # for each track, encoders of all quality levels
+        self.ref_counts = {}  # number of env instances sharing each stream
+        self.adaptation_tasks = {}  # quality adaptation for each peer connection
+        self.image_encoders = {}  # socket.io fallback; for each camera, created on the first viewer
+        self.image_viewers = {}  # (mode, ImageViewer) for each sid using the fallback
+        self.image_executor = ThreadPoolExecutor(max_workers=image_workers)
 
-    def setup(self, mode, capture_fn, num_track):
+    def setup(self, mode, capture_fn, num_track, mosaic=False):
+        # a stream can be shared by several env instances, e.g. prerendered data collection scenes
+        self.ref_counts[mode] = self.ref_counts.get(mode, 0) + 1
+        if mode in self.capturers:
+            return
         self.capturers[mode] = FrameCapturer(capture_fn)
-        self.relays[mode] = MediaRelay()
+        self.num_tracks[mode] = num_track
+        # each camera is encoded once and the packets are sent to all viewers
+        keys = [camera_key(i) for i in range(num_track)]
+        capturer = self.capturers[mode]
+        if mosaic:
+            # all cameras in a single track; the frontend maps the tiles back to the robots
+            self.encoders[mode] = [[MosaicEncoder(capturer, keys, level) for level in range(len(quality_levels))]]
+        else:
+            self.encoders[mode] = [
+                [CameraEncoder(capturer, key, level=level) for level in range(len(quality_levels))] for key in keys
+            ]
 
-        # self.base_tracks[mode] = [ImageStreamTrack(self.capturers[mode], i) for i in range(num_track)]
-        # self.tracks[mode] = [self.relays[mode].subscribe(track) for track in self.base_tracks[mode]]
-        self.num_track = num_track
+    def can_focus(self, mode) -> bool:
+        # tiles of a mosaic must have the same size
+        return self.num_tracks[mode] > 1 and not isinstance(self.encoders[mode][0][0], MosaicEncoder)
+
+    def set_focus(self, mode, camera_indices):
+        """Render the cameras focused by the users in high resolution and the others as thumbnails."""
+        if mode not in self.capturers or not self.can_focus(mode):
+            return
+        self.capturers[mode].resolutions = {
+            camera_key(i): focus_resolution if i in camera_indices else thumbnail_resolution
+            for i in range(self.num_tracks[mode])
+        }
 
     def get_tracks(self, mode):
-        # TODO
-        # tracks = [self.relays[mode].subscribe(track) for track in self.base_tracks[mode]]
-        # return tracks
+        # tracks for a new peer connection; they have to be sent with H264 (see force_codec)
+        return [EncodedStreamTrack(encoders) for encoders in self.encoders[mode]]
+
+    def subscribe_images(self, mode, sid, send_fn):
+        """Send the cameras of `mode` to `sid` as compressed images instead of WebRTC tracks.
 
-        self.base_tracks[mode] = [ImageStreamTrack(self.capturers[mode], i) for i in range(self.num_track)]
-        self.tracks[mode] = [self.relays[mode].subscribe(track) for track in self.base_tracks[mode]]
-        return self.tracks[mode]
+        `send_fn(payload, callback)` sends an image to the client, which calls `callback` once shown.
+        """
+        self.unsubscribe_images(sid)
+        if mode not in self.image_encoders:
+            # each camera is compressed once and the images are sent to all fallback viewers
+            self.image_encoders[mode] = [
+                ImageEncoder(self.capturers[mode], camera_key(i), i, self.image_executor)
+                for i in range(self.num_tracks[mode])
+            ]
+        viewer = ImageViewer(send_fn)
+        self.image_viewers[sid] = (mode, viewer)
+        for encoder in self.image_encoders[mode]:
+            encoder.subscribe(viewer)
+
+    def unsubscribe_images(self, sid):
+        if sid not in self.image_viewers:
+            return
+        mode, viewer = self.image_viewers.pop(sid)
+        for encoder in self.image_encoders.get(mode, []):
+            encoder.unsubscribe(viewer)
+        if viewer.num_dropped > 0:
+            print(f"{viewer.num_dropped} stale images dropped for {sid}")
+
+    def start_adaptation(self, sid, pc):
+        if sid in self.adaptation_tasks:
+            self.adaptation_tasks[sid].cancel()
+        self.adaptation_tasks[sid] = asyncio.create_task(self._adapt_quality(pc))
+
+    async def stop_adaptation(self, sid):
+        if sid in self.adaptation_tasks:
+            task = self.adaptation_tasks.pop(sid)
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    async def _adapt_quality(self, pc):
+        # switch the quality level of each track of the peer based on the receiver reports
+        num_good = {}
+        while True:
+            await asyncio.sleep(adaptation_interval_sec)
+            for sender in pc.getSenders():
+                track = sender.track
+                if not isinstance(track, EncodedStreamTrack):
+                    continue
+                report = await sender.getStats()
+                remote = [stats for stats in report.values() if stats.type == "remote-inbound-rtp"]
+                if len(remote) == 0:
+                    continue  # no receiver report yet
+                fraction_lost = remote[0].fractionLost / 256  # RTCP fixed point
+                rtt = remote[0].roundTripTime or 0
+                is_congested = track.queue.qsize() > max_queued_packets // 2  # sender cannot keep up
+                if fraction_lost > max_fraction_lost or rtt > max_rtt_sec or is_congested:
+                    track.set_level(track.level + 1)
+                    num_good[track] = 0
+                else:
+                    num_good[track] = num_good.get(track, 0) + 1
+                    if num_good[track] >= upgrade_after:
+                        track.set_level(track.level - 1)
+                        num_good[track] = 0
 
     async def cleanup(self, mode):
-        if mode in self.tracks:
-            del self.tracks[mode]
-        if mode in self.base_tracks:
-            for track in self.base_tracks[mode]:
-                track.stop()
-            del self.base_tracks[mode]
-        if mode in self.relays:
-            del self.relays[mode]
+        self.ref_counts[mode] = self.ref_counts.get(mode, 1) - 1
+        if self.ref_counts[mode] > 0:
+            return
+        del self.ref_counts[mode]
+        self.num_tracks.pop(mode, None)
+        if mode in self.encoders:
+            for encoders in self.encoders[mode]:
+                for encoder in encoders:
+                    await encoder.stop()
+            del self.encoders[mode]
+        for encoder in self.image_encoders.pop(mode, []):
+            await encoder.stop()
         if mode in self.capturers:
             await self.capturers[mode].stop()
             del self.capturers[mode]
 
 
+class CapturedFrame(NamedTuple):
+    seq: int  # increases by one for each capture
+    capture_time: float
+    sim_time: Optional[float]  # simulation time of the frame, if provided by the env
+    visuals: dict
+
+
 class FrameCapturer:
+    """Captures the visuals of an env and publishes them to the encoders through a condition."""
+
     def __init__(self, capture_fn):
-        self.frame = None
-        self.callbacks = {}
+        self.latest = CapturedFrame(0, 0.0, None, {})
+        self.condition = asyncio.Condition()
+        self.demands = {}  # camera keys requested by each subscriber with live tracks
+        self.resolutions = None  # render resolution of each camera key, if not the default
+        self.has_demand = asyncio.Event()
+        self.frames_captured_metrics = {}  # by camera key
         self.capture_fn = capture_fn
         self.task = asyncio.create_task(self.update_frame())
 
     async def update_frame(self):
         while True:
-            self.frame = await self.capture_fn()
-            for callback in self.callbacks.values():
-                callback(self.frame)
-            await asyncio.sleep(1 / fps)  # TODO: consider processing time?
+            # stay idle until someone watches, and only render the watched cameras
+            await self.has_demand.wait()
+            keys = set().union(*self.demands.values())
+            start = time.time()
+            visuals = await self.capture_fn(keys, self.resolutions)
+            async with self.condition:
+                self.latest = CapturedFrame(self.latest.seq + 1, time.time(), visuals.get("time"), visuals)
+                self.condition.notify_all()
+            for key in visuals:
+                if key.startswith("rgb:"):
+                    if key not in self.frames_captured_metrics:
+                        camera = telemetry.camera_label(key)
+                        self.frames_captured_metrics[key] = telemetry.frames_captured.labels(camera)
+                    self.frames_captured_metrics[key].inc()
+            await asyncio.sleep(max(0, 1 / fps - (time.time() - start)))
+
+    async def wait_frame(self, last_seq: int) -> CapturedFrame:
+        """Wait for a frame newer than `last_seq` and return it."""
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.latest.seq > last_seq)
+            return self.latest
+
+    def set_demand(self, key, camera_keys):
+        if camera_keys:
+            self.demands[key] = set(camera_keys)
+        else:
+            self.demands.pop(key, None)
+        if self.demands:
+            self.has_demand.set()
+        else:
+            self.has_demand.clear()
 
     async def stop(self):
         self.task.cancel()
@@ -67,37 +253,334 @@ class FrameCapturer:
             pass
         print("Frame capturer stopped")
 
-    def subscribe(self, key, callback):
-        self.callbacks[key] = callback
 
-    def unsubscribe(self, key):
-        if key in self.callbacks:
-            del self.callbacks[key]
-            print(f"unsubscribed {key}")
+class CameraEncoder:
+    """Encodes the frames of a camera to H264 once and fans the packets out to all viewers.
 
+    There is one encoder per quality level; viewers are moved between them by StreamManager.
+    """
+
+    def __init__(self, capturer: FrameCapturer, key: str, keys: list = None, level: int = 0):
+        self.key = f"{key}@{level}"  # key for the capturer
+        self.keys = keys or [key]  # camera keys used by the encoder
+        self.level = quality_levels[level]
+        self.tracks = set()
+        self.codec = None
+        self.frame_pool = []  # preallocated yuv420p VideoFrames
+        self.frame_pool_idx = 0
+        self.force_keyframe = False
+        self.last_keyframe_time = 0.0
+        self.last_frame_time = 0.0
+        self.last_sent_time = 0.0
+        self.last_thumbnail = None  # subsampled copy of the last encoded frame
+        self.start_time = time.time()
+        camera = telemetry.camera_label(key)
+        self.frames_sent_metric = telemetry.frames_sent.labels(camera)
+        self.frames_skipped_metric = telemetry.frames_skipped.labels(camera)
+        self.frames_dropped_metric = telemetry.frames_dropped.labels(camera)
+        self.frames_duplicated_metric = telemetry.frames_duplicated.labels(camera)
+        self.frame_age_metric = telemetry.frame_age.labels(camera)
+        self.packets_dropped_metric = telemetry.packets_dropped.labels(camera)  # by the tracks of the encoder
 
-class ImageStreamTrack(VideoStreamTrack):
-    def __init__(self, capturer: FrameCapturer, camera_idx: int):
-        super().__init__()
-        self.key = f"rgb:franka{camera_idx}_front_cam:256x256:2d"
-        self.frame = None
         self.capturer = capturer
-        self.capturer.subscribe(self.id, self.on_frame)
+        self.task = asyncio.create_task(self.run())
+
+    def _select(self, visuals):
+        return visuals.get(self.keys[0])
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        last = self.capturer.latest
+        while True:
+            # wake up as soon as a new frame is captured
+            captured = await self.capturer.wait_frame(last.seq)
+            if len(self.tracks) > 0:
+                self.frames_dropped_metric.inc(captured.seq - last.seq - 1)
+                if captured.sim_time is not None and captured.sim_time == last.sim_time:
+                    self.frames_duplicated_metric.inc()
+            last = captured
+            frame = self._select(captured.visuals)
+            if len(self.tracks) == 0 or frame is None:
+                continue  # nobody is watching
+            # encode in a thread as aiortc does; frames captured in the meantime are dropped
+            packets = await loop.run_in_executor(None, self._encode, frame, captured.capture_time)
+            if len(packets) > 0:
+                self.frame_age_metric.observe(time.time() - captured.capture_time)
+                self.frames_sent_metric.inc()
+            for packet in packets:
+                for track in list(self.tracks):
+                    track.put(packet)
+
+    def _prepare(self, frame):
+        # frames are captured as yuv420p (converted in the env workers)
+        return yuv420p_planes(frame)
+
+    def _get_pool_frame(self, width, height):
+        if len(self.frame_pool) == 0 or (self.frame_pool[0].width, self.frame_pool[0].height) != (width, height):
+            self.frame_pool = [VideoFrame(width, height, "yuv420p") for _ in range(frame_pool_size)]
+        # x264 copies the input picture, so a frame can be reused once encode() returns
+        self.frame_pool_idx = (self.frame_pool_idx + 1) % frame_pool_size
+        return self.frame_pool[self.frame_pool_idx]
+
+    def _encode(self, frame, capture_time):
+        now = time.time()
+        if now - self.last_frame_time < 1 / self.level["fps"] - 1e-3:
+            return []  # frame rate of the quality level
+        self.last_frame_time = now
+        y, u, v = self._prepare(frame)
+        # scale of the quality level by subsampling the planes; even size for yuv420p
+        stride = round(1 / self.level["scale"])
+        width = y.shape[1] // stride // 2 * 2
+        height = y.shape[0] // stride // 2 * 2
+        planes = (
+            y[::stride, ::stride][:height, :width],
+            u[::stride, ::stride][:height // 2, :width // 2],
+            v[::stride, ::stride][:height // 2, :width // 2],
+        )
+        if self.codec is None or (self.codec.width, self.codec.height) != (width, height):
+            self.codec = _create_h264_codec(width, height, self.level["bitrate"])
+            self.force_keyframe = True
+        if now - self.last_keyframe_time > keyframe_interval_sec:
+            self.force_keyframe = True
+
+        # idle robots render the same frame; skip encoding it except for keepalives and keyframes
+        thumbnail = planes[0][::change_detection_stride, ::change_detection_stride].astype(np.int16)
+        is_unchanged = (
+            self.last_thumbnail is not None
+            and self.last_thumbnail.shape == thumbnail.shape
+            and np.abs(thumbnail - self.last_thumbnail).max() <= change_threshold
+        )
+        if is_unchanged and not self.force_keyframe and now - self.last_sent_time < keepalive_interval_sec:
+            self.frames_skipped_metric.inc()
+            return []
+        if not is_unchanged:
+            self.last_thumbnail = thumbnail
+        self.last_sent_time = now
+
+        frame = self._get_pool_frame(width, height)
+        for plane, data in zip(frame.planes, planes):
+            # rows of the plane may be padded
+            np.frombuffer(plane, np.uint8).reshape(-1, plane.line_size)[:data.shape[0], :data.shape[1]] = data
+        frame.pict_type = "I" if self.force_keyframe else "NONE"
+        if self.force_keyframe:
+            self.force_keyframe = False
+            self.last_keyframe_time = now
+
+        packets = self.codec.encode(frame)
+        pts = int((capture_time - self.start_time) / VIDEO_TIME_BASE)
+        for packet in packets:
+            # H264Encoder.pack in each RTCRtpSender reads the timestamp from the packet
+            packet.pts = pts
+            packet.time_base = VIDEO_TIME_BASE
+        return packets
+
+    def request_keyframe(self):
+        self.force_keyframe = True
+
+    def subscribe(self, track):
+        self.tracks.add(track)
+        self.capturer.set_demand(self.key, self.keys)
+        self.request_keyframe()  # the new viewer cannot decode until the next keyframe
+
+    def unsubscribe(self, track):
+        self.tracks.discard(track)
+        if len(self.tracks) == 0:
+            self.capturer.set_demand(self.key, None)  # stop rendering the cameras nobody watches
+
+    async def stop(self):
+        self.capturer.set_demand(self.key, None)
+        for track in list(self.tracks):
+            track.stop()
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+
+
+class MosaicEncoder(CameraEncoder):
+    """Tiles the frames of several cameras into one frame, encoded as a single stream."""
+
+    def __init__(self, capturer: FrameCapturer, keys: list, level: int = 0):
+        self.cols, self.rows = mosaic_layout(len(keys))
+        self.buffers = None  # preallocated yuv420p planes of the mosaic, only touched by the encoding thread
+        super().__init__(capturer, "mosaic", keys, level)
+
+    def _select(self, visuals):
+        if not all(key in visuals for key in self.keys):
+            return None
+        return visuals
+
+    def _prepare(self, frame):
+        planes = [yuv420p_planes(frame[key]) for key in self.keys]
+        h, w = planes[0][0].shape
+        if self.buffers is None or self.buffers[0].shape != (self.rows * h, self.cols * w):
+            self.buffers = [
+                np.zeros((self.rows * h, self.cols * w), dtype=np.uint8),
+                np.full((self.rows * h // 2, self.cols * w // 2), 128, dtype=np.uint8),
+                np.full((self.rows * h // 2, self.cols * w // 2), 128, dtype=np.uint8),
+            ]
+        for i, buffer in enumerate(self.buffers):
+            tile_frames(buffer, [p[i] for p in planes], self.cols)
+        return self.buffers
+
+
+class ImageEncoder:
+    """Compresses the frames of a camera to images once for all the viewers of the socket.io fallback."""
+
+    def __init__(self, capturer: FrameCapturer, key: str, camera_idx: int, executor: ThreadPoolExecutor):
+        self.key = f"image:{key}"  # key for the capturer
+        self.camera_key = key
+        self.camera_idx = camera_idx
+        self.executor = executor
+        self.viewers = set()
+        self.capturer = capturer
+        self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        last = self.capturer.latest
+        last_encoded_time = 0.0
+        while True:
+            last = await self.capturer.wait_frame(last.seq)
+            frame = last.visuals.get(self.camera_key)
+            if len(self.viewers) == 0 or frame is None:
+                continue
+            if last.capture_time - last_encoded_time < 1 / image_fps - 1e-3:
+                continue
+            last_encoded_time = last.capture_time
+            image = await loop.run_in_executor(self.executor, _compress_image, frame)
+            payload = {"camera": self.camera_idx, "seq": last.seq, "format": image_format, "image": image}
+            for viewer in list(self.viewers):
+                viewer.send(self.camera_idx, payload)
+
+    def subscribe(self, viewer):
+        self.viewers.add(viewer)
+        self.capturer.set_demand(self.key, [self.camera_key])
+
+    def unsubscribe(self, viewer):
+        self.viewers.discard(viewer)
+        if len(self.viewers) == 0:
+            self.capturer.set_demand(self.key, None)
+
+    async def stop(self):
+        self.capturer.set_demand(self.key, None)
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+
+
+class ImageViewer:
+    """A client of the socket.io fallback; at most one image per camera is in flight.
+
+    While the client has not acknowledged the previous image of a camera, only the latest image is
+    kept and older ones are dropped, so a slow client sees fewer but fresh frames.
+    """
+
+    def __init__(self, send_fn):
+        self.send_fn = send_fn
+        self.sent_times = {}  # send time of the image in flight for each camera
+        self.pending = {}  # latest image waiting for the acknowledgement for each camera
+        self.num_dropped = 0
+
+    def send(self, camera_idx, payload):
+        sent_time = self.sent_times.get(camera_idx)
+        if sent_time is not None and time.time() - sent_time < image_ack_timeout_sec:
+            if camera_idx in self.pending:
+                self.num_dropped += 1
+            self.pending[camera_idx] = payload
+            return
+        self._emit(camera_idx, payload)
+
+    def _emit(self, camera_idx, payload):
+        self.sent_times[camera_idx] = time.time()
+        asyncio.create_task(self.send_fn(payload, lambda *args: self._on_ack(camera_idx)))
+
+    def _on_ack(self, camera_idx):
+        self.sent_times.pop(camera_idx, None)
+        if camera_idx in self.pending:
+            self._emit(camera_idx, self.pending.pop(camera_idx))
+
+
+def _compress_image(frame):
+    # frames are captured as yuv420p
+    rgb = VideoFrame.from_ndarray(frame, format="yuv420p").to_ndarray(format="rgb24")
+    buf = io.BytesIO()
+    Image.fromarray(rgb).save(buf, format=image_format.upper(), quality=image_quality)
+    return buf.getvalue()
+
+
+class EncodedStreamTrack(MediaStreamTrack):
+    """Track of a viewer, forwarding the packets of a CameraEncoder without re-encoding."""
+
+    kind = "video"
+
+    def __init__(self, encoders: list):
+        super().__init__()
+        self.encoders = encoders  # encoders of the camera for each quality level
+        self.level = 0
+        self.encoder = encoders[self.level]
+        self.queue = asyncio.Queue(maxsize=max_queued_packets)
+        self.waiting_keyframe = True
+        self.first_packet_sent = asyncio.Event()  # to measure the connection setup time
+        # subscribed at the first recv, once the connection is up: until then, the packets would pile up
+        # and the overflows would request keyframes from the encoder shared by all viewers
+        self.is_subscribed = False
+
+    def set_level(self, level):
+        level = min(max(level, 0), len(self.encoders) - 1)
+        if level == self.level or self.readyState != "live":
+            return
+        print(f"Track {self.id}: quality level {self.level} -> {level}")
+        if self.is_subscribed:
+            self.encoder.unsubscribe(self)
+        self.level = level
+        self.encoder = self.encoders[level]
+        # the viewer's decoder switches to the new stream at its next keyframe
+        self.waiting_keyframe = True
+        if self.is_subscribed:
+            self.encoder.subscribe(self)
+
+    def put(self, packet):
+        if self.waiting_keyframe and not packet.is_keyframe:
+            return  # cannot be decoded by the viewer
+        if self.queue.full():
+            # the viewer is too slow; drop the backlog and restart from a keyframe
+            while not self.queue.empty():
+                self.queue.get_nowait()
+                self.encoder.packets_dropped_metric.inc()
+            self.waiting_keyframe = True
+            self.encoder.request_keyframe()
+            return
+        self.waiting_keyframe = False
+        self.queue.put_nowait(packet)
 
     async def recv(self):
-        pts, time_base = await self.next_timestamp()  # 30fps
-        while self.frame is None:
-            await asyncio.sleep(0.1)
-        frame = VideoFrame.from_ndarray(self.frame, format="rgb24")
-        frame.pts = pts
-        frame.time_base = time_base
-        return frame
-
-    def on_frame(self, frame):
-        # self.frame = frame[self.key]
-        if frame is not None and self.key in frame:
-            self.frame = frame[self.key]
+        if self.readyState != "live":
+            raise MediaStreamError
+        if not self.is_subscribed:
+            self.is_subscribed = True
+            self.encoder.subscribe(self)
+        packet = await self.queue.get()
+        self.first_packet_sent.set()
+        return packet
 
     def stop(self):
-        self.capturer.unsubscribe(self.id)
+        if self.is_subscribed:
+            self.encoder.unsubscribe(self)
         super().stop()
+
+
+def _create_h264_codec(width, height, bitrate=quality_levels[0]["bitrate"]):
+    # same settings as aiortc's H264Encoder
+    codec = av.CodecContext.create("libx264", "w")
+    codec.width = width
+    codec.height = height
+    codec.bit_rate = bitrate
+    codec.pix_fmt = "yuv420p"
+    codec.framerate = fractions.Fraction(fps, 1)
+    codec.time_base = fractions.Fraction(1, fps)
+    codec.options = {"profile": "baseline", "level": "31", "tune": "zerolatency", "preset": "ultrafast"}
+    return codec
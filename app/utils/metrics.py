@@ -1,10 +1,13 @@
 import json
+import os
+import queue
+import threading
 import time
 from pathlib import Path
+from typing import Optional
 
 import jsonlines
 import numpy as np
-import pandas as pd
 
 
 class taskCompletionTimer:
@@ -22,33 +25,131 @@ class taskCompletionTimer:
         self.elapsed = time.time() - self.start_time
 
 
+_close = object()  # sentinel to stop a HistoryWriter
+
+
+class HistoryWriter:
+    """Writes records to a jsonl file from a background thread.
+
+    Records are written as they come and synced to disk (flush and fsync) at most every
+    `sync_interval_sec`, so a crash of the server loses at most that much of the session.
+    """
+
+    def __init__(self, path: Path, sync_interval_sec: float = 1.0):
+        self.path = path
+        self.sync_interval_sec = sync_interval_sec
+        self.queue = queue.SimpleQueue()
+        self.error = None
+        self.thread = threading.Thread(target=self._run, name="history-writer", daemon=True)
+        self.thread.start()
+
+    def write(self, record: dict):
+        self.queue.put(record)
+
+    def close(self, wait: bool = True):
+        """Write the pending records and close the file; raises if writing failed."""
+        self.queue.put(_close)
+        if wait:
+            self.thread.join()
+            if self.error is not None:
+                raise self.error
+
+    def _run(self):
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            # a restarted session replaces the history of the stopped one, like the expId it belongs to
+            with open(self.path, "w") as f, jsonlines.Writer(f) as writer:
+                last_sync = time.monotonic()
+                is_synced = True
+                while True:
+                    timeout = None if is_synced else max(0.0, last_sync + self.sync_interval_sec - time.monotonic())
+                    try:
+                        record = self.queue.get(timeout=timeout)
+                    except queue.Empty:
+                        record = None  # time to sync
+                    if record is _close:
+                        break
+                    if record is not None:
+                        writer.write(record)
+                        is_synced = False
+                    if not is_synced and time.monotonic() - last_sync >= self.sync_interval_sec:
+                        _sync(f)
+                        last_sync = time.monotonic()
+                        is_synced = True
+                _sync(f)
+        except Exception as e:
+            print(f"Failed to write {self.path}: {e!r}")
+            self.error = e
+
+
+def _sync(f):
+    f.flush()
+    os.fsync(f.fileno())
+
+
 class InteractionRecorder:
+    """Records the commands of a session.
+
+    Each record is appended to the history file of the session as it happens (see HistoryWriter);
+    only the aggregates needed when the session is saved are kept in memory.
+    """
+
     def __init__(self):
-        self.history = []
         self.userinfo = {}
-
-    def reset(self):
-        self.history = []
+        self.writer: Optional[HistoryWriter] = None
+        self.usernames = set()
+        self.agent_ids = set()
+
+    def reset(self, history_path: Optional[Path] = None):
+        """Start a new session, whose records are written to `history_path` if given."""
+        self.close()
+        self.writer = HistoryWriter(history_path) if history_path is not None else None
         self.userinfo = {}
+        self.usernames = set()
+        self.agent_ids = set()
+
+    def close(self, wait: bool = False):
+        """Stop writing the history, which is not kept; the writer finishes in the background unless `wait`."""
+        if self.writer is not None:
+            writer, self.writer = self.writer, None
+            try:
+                writer.close(wait=wait)
+            except Exception:
+                pass  # printed by the writer
+
+    def detach(self):
+        """Hand the session over to a new recorder, e.g. to save it in the background, and start over empty."""
+        recorder = InteractionRecorder()
+        recorder.userinfo = self.userinfo
+        recorder.writer = self.writer
+        recorder.usernames = self.usernames
+        recorder.agent_ids = self.agent_ids
+        self.writer = None
+        self.reset()
+        return recorder
 
     def add_user(self, user_id: str, userinfo: dict):
         self.userinfo[user_id] = userinfo
 
     def record(self, user_id: str, data: dict):
         assert user_id in self.userinfo, "User not added"
-        self.history.append(data)
-
-    def save_session(self, save_dir: Path): 
-        """Saves the usernames and number of agents in session"""
-        with jsonlines.open(save_dir / "history.jsonl", mode="w") as writer:
-            writer.write_all(self.history)
-
-        _data = self.userinfo.copy()
-
-        usernames = list(set([x['username'] for x in self.history]))
-        num_agents = len(set([x['agentId'] for x in self.history]))
+        if self.writer is not None:
+            self.writer.write(data)  # must not be modified afterwards
+        self.usernames.add(data["username"])
+        self.agent_ids.add(data["agentId"])
+
+    def save_session(self, save_dir: Path):
+        """Completes the history of the session and saves the usernames and number of agents in session"""
+        if self.writer is not None:
+            assert self.writer.path == save_dir / "history.jsonl", "History written elsewhere"
+            self.writer.close()
+            self.writer = None
+        else:
+            (save_dir / "history.jsonl").touch()  # no command recorded
+
+        usernames = list(self.usernames)
         with jsonlines.open(save_dir / "info.json", mode="w") as writer:
-            writer.write({"usernames": usernames, "numAgents": num_agents})
+            writer.write({"usernames": usernames, "numAgents": len(self.agent_ids)})
 
         return usernames
         
@@ -81,6 +182,8 @@ def compute_usermetrics(user_log_dir: Path, username, save=False): #change to di
     log_dir = user_log_dir.parents[1]
     exp_log_dir = log_dir / expid
 
+    import pandas as pd  # only needed when a session is saved, in the persistence worker
+
     df_hist = pd.read_json(exp_log_dir / "history.jsonl", orient="records", lines=True)
 
     metrics = {}
@@ -106,6 +209,8 @@ def compute_sessionmetrics(exp_log_dir: Path, info, save=False): #remove user me
     """
     Given the interaction history, compute metrics and save the summary to a json file 
     """
+    import pandas as pd
+
     df_hist = pd.read_json(exp_log_dir / "history.jsonl", orient="records", lines=True)
 
     metrics = {}
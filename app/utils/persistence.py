@@ -0,0 +1,44 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class PersistenceWorker:
+    """Runs file I/O and metric computation in a background thread so that the event loop never waits for it.
+
+    Jobs run one at a time in submission order, e.g. the survey of a user is saved after the logs of
+    the session it refers to.
+    """
+
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="persistence")
+        self.num_pending = 0
+
+    async def run(self, name: str, fn, *args):
+        """Run `fn(*args)` in the worker and return its result."""
+        loop = asyncio.get_running_loop()
+        self.num_pending += 1
+        start = time.time()
+        try:
+            result = await loop.run_in_executor(self.executor, fn, *args)
+        except Exception as e:
+            print(f"Persistence of {name} failed: {e!r}")
+            raise
+        finally:
+            self.num_pending -= 1
+        print(f"Persistence of {name} done in {time.time() - start:.2f} s ({self.num_pending} pending)")
+        return result
+
+    def submit(self, name: str, fn, *args, on_done=None) -> asyncio.Task:
+        """Run `fn(*args)` in the worker without waiting; `on_done(error)` is awaited once it finishes."""
+
+        async def job():
+            error = None
+            try:
+                await self.run(name, fn, *args)
+            except Exception as e:
+                error = e
+            if on_done is not None:
+                await on_done(error)
+
+        return asyncio.create_task(job())
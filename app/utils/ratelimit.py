@@ -0,0 +1,83 @@
+import time
+
+import socketio
+from socketio import packet
+
+from app.utils import telemetry
+
+
+class TokenBucket:
+    """Allows `rate` events per second on average, with bursts of up to `burst` events."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last_refill = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def try_take(self) -> bool:
+        self._refill()
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def time_until_available(self) -> float:
+        self._refill()
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+
+class BoundedAsyncServer(socketio.AsyncServer):
+    """socket.io server that drops events to clients whose outgoing queue is full.
+
+    Engine.IO queues the packets of each client without limit, so a viewer on a slow link would
+    make the server hold every event it cannot receive yet. Once `max_queued_packets` are waiting
+    for a client, further events to it are dropped until its queue drains. Connection packets and
+    acks are always sent; binary events are dropped together with their attachments.
+    """
+
+    def __init__(self, *args, max_queued_packets: int = 256, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.max_queued_packets = max_queued_packets
+
+    def _should_drop(self, eio_sid, data) -> bool:
+        try:
+            socket = self.eio._get_socket(eio_sid)
+        except KeyError:
+            return False  # engineio logs it
+        if isinstance(data, bytes):
+            # attachment of a binary event; follows its header, see emit in socketio.AsyncManager
+            if getattr(socket, "skipped_attachments", 0) > 0:
+                socket.skipped_attachments -= 1
+                return True
+            return False
+        if not isinstance(data, str) or data[:1] not in (str(packet.EVENT), str(packet.BINARY_EVENT)):
+            return False
+
+        is_full = socket.queue.qsize() >= self.max_queued_packets
+        if is_full != getattr(socket, "is_dropping", False):
+            socket.is_dropping = is_full
+            print(f"Outgoing queue of {eio_sid} is {'full, dropping events' if is_full else 'drained'}")
+        if not is_full:
+            return False
+        if data[0] == str(packet.BINARY_EVENT):
+            socket.skipped_attachments = int(data[1:data.index("-")])
+        telemetry.events_dropped.labels("backlog").inc()
+        return True
+
+    async def _send_packet(self, eio_sid, pkt):
+        encoded_packet = pkt.encode()
+        if not isinstance(encoded_packet, list):
+            encoded_packet = [encoded_packet]
+        for ep in encoded_packet:
+            if not self._should_drop(eio_sid, ep):
+                await self.eio.send(eio_sid, ep)
+
+    async def _send_eio_packet(self, eio_sid, eio_pkt):
+        if not self._should_drop(eio_sid, eio_pkt.data):
+            await self.eio.send_packet(eio_sid, eio_pkt)
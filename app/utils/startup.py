@@ -0,0 +1,39 @@
+import os
+import time
+
+
+class StartupTimer:
+    """Breakdown of the server startup, printed with STARTUP_PROFILE=1.
+
+    Steps are timed from the start of the process to the first HTTP response.
+    """
+
+    def __init__(self):
+        self.enabled = os.getenv("STARTUP_PROFILE", "0") == "1"
+        self.start = time.time()
+        if self.enabled:
+            import psutil
+
+            self.start = psutil.Process().create_time()
+        self.last = self.start
+        self.steps = []
+        self.done = False
+
+    def mark(self, name: str):
+        now = time.time()
+        self.steps.append((name, now - self.last))
+        self.last = now
+
+    def report(self):
+        if self.done:
+            return
+        self.done = True
+        if not self.enabled:
+            return
+        print("Startup time:")
+        for name, duration in self.steps:
+            print(f"  {name:<24} {duration * 1000:8.1f} ms")
+        print(f"  {'total':<24} {(self.last - self.start) * 1000:8.1f} ms")
+
+
+startup_timer = StartupTimer()
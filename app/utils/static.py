@@ -0,0 +1,82 @@
+import json
+import mimetypes
+import os
+from pathlib import Path
+
+from markupsafe import Markup
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import NotModifiedResponse, StaticFiles
+
+manifest_name = "manifest.json"  # source path -> hashed path, written by app/scripts/build_static.py
+compressed_suffixes = {"br": ".br", "gzip": ".gz"}  # in order of preference
+immutable_cache_control = "public, max-age=31536000, immutable"
+
+
+class HashedStaticFiles(StaticFiles):
+    """Static files with content-hashed URLs, served precompressed and cached for good.
+
+    The assets built by app/scripts/build_static.py (`build_dir`) are served next to the sources
+    (`directory`). Hashed files never change, so browsers may keep them without revalidation, and
+    their gzip/brotli variants are sent to the browsers that accept them. Unhashed files (all of
+    them if the assets were not built) are revalidated by the browsers at each use.
+
+    Templates get their URLs from `url` and the import map of the JS modules from `import_map`,
+    which redirects the relative imports between modules (e.g. "./chart.js") to the hashed files.
+    """
+
+    def __init__(self, directory: Path, build_dir: Path, url_prefix: str = "/static"):
+        super().__init__(directory=directory)
+        self.url_prefix = url_prefix
+        self.build_dir = os.path.realpath(build_dir)
+        self.manifest = {}
+        self.encodings = {}  # hashed path -> available encodings
+        manifest_path = Path(build_dir) / manifest_name
+        if manifest_path.exists():
+            self.manifest = json.loads(manifest_path.read_text())
+            self.all_directories = [self.build_dir, *self.all_directories]
+            for path in self.manifest.values():
+                self.encodings[path] = [
+                    encoding
+                    for encoding, suffix in compressed_suffixes.items()
+                    if os.path.exists(os.path.join(self.build_dir, path + suffix))
+                ]
+        else:
+            print("Static assets are not built, serving the sources (see app/scripts/build_static.py)")
+
+    def url(self, path: str) -> str:
+        return f"{self.url_prefix}/{self.manifest.get(path, path)}"
+
+    def import_map(self) -> Markup:
+        imports = {f"{self.url_prefix}/{path}": self.url(path) for path in self.manifest if path.endswith(".js")}
+        return Markup(f'<script type="importmap">{json.dumps({"imports": imports})}</script>')
+
+    def file_response(self, full_path, stat_result, scope, status_code: int = 200) -> Response:
+        path = None
+        if str(full_path).startswith(self.build_dir + os.sep):
+            path = os.path.relpath(full_path, self.build_dir).replace(os.sep, "/")
+        if path not in self.encodings:
+            # not a hashed file, e.g. a source or the manifest, which change at each build
+            response = super().file_response(full_path, stat_result, scope, status_code)
+            response.headers["Cache-Control"] = "no-cache"
+            return response
+
+        request_headers = Headers(scope=scope)
+        accepted = {value.split(";")[0].strip() for value in request_headers.get("accept-encoding", "").split(",")}
+        encoding = next((e for e in self.encodings.get(path, ()) if e in accepted), None)
+        headers = {"Cache-Control": immutable_cache_control, "Vary": "Accept-Encoding"}
+        if encoding is None:
+            response = FileResponse(full_path, status_code=status_code, stat_result=stat_result, headers=headers)
+        else:
+            headers["Content-Encoding"] = encoding
+            compressed_path = str(full_path) + compressed_suffixes[encoding]
+            response = FileResponse(
+                compressed_path,
+                status_code=status_code,
+                headers=headers,
+                media_type=mimetypes.guess_type(path)[0],
+                stat_result=os.stat(compressed_path),
+            )
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+        return response
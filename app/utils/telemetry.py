@@ -0,0 +1,64 @@
+"""Prometheus metrics of the server hot paths, exported at /metrics.
+
+Updating a metric only takes a lock and an addition, so they are left on in production. Labels are
+limited to bounded values (env ids, modes, camera indices) to keep the number of series small.
+"""
+
+from prometheus_client import Counter, Gauge, Histogram
+
+# buckets in seconds, from well below a frame (33 ms) to seconds
+_latency_buckets = (0.001, 0.0025, 0.005, 0.01, 0.02, 0.033, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+event_loop_lag = Histogram(
+    "event_loop_lag_seconds", "Delay of the event loop in waking up a sleeping task", buckets=_latency_buckets
+)
+env_tick_period = Histogram(
+    "env_tick_period_seconds", "Time between two steps of an EnvRunner", ["env_id"], buckets=_latency_buckets
+)
+env_tick_overruns = Counter(
+    "env_tick_overruns_total", "Steps of an EnvRunner whose work took longer than dt_step", ["env_id"]
+)
+env_worker_roundtrip = Histogram(
+    "env_worker_roundtrip_seconds",
+    "Round trip of a request to the sub env worker processes",
+    ["op"],
+    buckets=_latency_buckets,
+)
+frames_captured = Counter("frames_captured_total", "Camera frames captured from the envs", ["camera"])
+frames_sent = Counter("frames_sent_total", "Camera frames encoded and sent to viewers", ["camera"])
+frames_skipped = Counter("frames_skipped_total", "Unchanged camera frames not encoded", ["camera"])
+frames_dropped = Counter(
+    "frames_dropped_total", "Captured camera frames not encoded because the encoder was busy", ["camera"]
+)
+frames_duplicated = Counter(
+    "frames_duplicated_total", "Captured camera frames with the same simulation time as the previous one", ["camera"]
+)
+frame_age = Histogram(
+    "frame_age_seconds",
+    "Time from the capture of a frame to its packets being queued for the viewers",
+    ["camera"],
+    buckets=_latency_buckets,
+)
+packets_dropped = Counter("packets_dropped_total", "Video packets dropped because a viewer was too slow", ["camera"])
+webrtc_peers = Gauge("webrtc_peers", "Open WebRTC peer connections")
+webrtc_setup_time = Histogram(
+    "webrtc_setup_seconds",
+    "Time from the offer request to the first video packet",
+    buckets=(0.1, 0.25, 0.5, 1.0, 2.0, 3.0, 5.0, 7.5, 10.0, 20.0, 30.0, 60.0),
+)
+commands = Counter("commands_total", "Commands received from the clients", ["mode"])
+command_handling_time = Histogram(
+    "command_handling_seconds", "Time to handle a command and broadcast it", buckets=_latency_buckets
+)
+events_throttled = Counter("events_throttled_total", "Events from clients over their rate limit", ["event"])
+events_dropped = Counter(
+    "events_dropped_total",
+    "Events dropped: superseded while throttled (stale) or to clients with a full outgoing queue (backlog)",
+    ["reason"],
+)
+
+
+def camera_label(key: str) -> str:
+    # e.g. "rgb:franka3_front_cam:256x256:2d" -> "3"
+    name = key.split(":")[1] if ":" in key else key
+    return name[len("franka"):].split("_")[0] if name.startswith("franka") else name
@@ -0,0 +1,34 @@
+import numpy as np
+
+# BT.601 limited range, as used by libswscale for rgb24 -> yuv420p
+_Y_COEFS = np.array([0.257, 0.504, 0.098], dtype=np.float32)
+_U_COEFS = np.array([-0.148, -0.291, 0.439], dtype=np.float32)
+_V_COEFS = np.array([0.439, -0.368, -0.071], dtype=np.float32)
+
+
+def rgb_to_yuv420p(image: np.ndarray) -> np.ndarray:
+    """Convert an RGB image (H, W, 3) to a yuv420p (I420) image of shape (H * 3 / 2, W).
+
+    The layout is the one of `VideoFrame.from_ndarray(..., format="yuv420p")`. H and W must be even.
+    """
+    h, w = image.shape[:2]
+    rgb = image.astype(np.float32)
+    # chroma is computed on the mean of each 2x2 block
+    rgb_sub = rgb.reshape(h // 2, 2, w // 2, 2, 3).mean(axis=(1, 3))
+
+    out = np.empty((h * 3 // 2, w), dtype=np.uint8)
+    flat = out.reshape(-1)
+    flat[:h * w] = np.clip(rgb @ _Y_COEFS + 16, 0, 255).ravel()
+    flat[h * w:h * w * 5 // 4] = np.clip(rgb_sub @ _U_COEFS + 128, 0, 255).ravel()
+    flat[h * w * 5 // 4:] = np.clip(rgb_sub @ _V_COEFS + 128, 0, 255).ravel()
+    return out
+
+
+def yuv420p_planes(image: np.ndarray):
+    """Return views of the Y, U and V planes of a yuv420p image returned by `rgb_to_yuv420p`."""
+    h, w = image.shape[0] * 2 // 3, image.shape[1]
+    flat = image.reshape(-1)
+    y = flat[:h * w].reshape(h, w)
+    u = flat[h * w:h * w * 5 // 4].reshape(h // 2, w // 2)
+    v = flat[h * w * 5 // 4:].reshape(h // 2, w // 2)
+    return y, u, v
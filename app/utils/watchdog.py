@@ -0,0 +1,93 @@
+import asyncio
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from typing import Optional
+
+from app.utils import telemetry
+
+max_stack_depth = 40  # innermost frames kept per stall
+
+
+class LoopWatchdog:
+    """Detects stalls of the event loop and captures the stack of the code holding it.
+
+    A task on the loop beats every `interval_sec`. A thread checks the beats and, when none came
+    for `threshold_sec`, takes the stack of the loop thread. The thread keeps running while the
+    loop is blocked, so the stack shows the blocking code (an env step, a pipe recv, a pandas
+    call, ...) rather than where the loop resumed. Stalls are kept in a ring buffer of `max_stalls`.
+    """
+
+    def __init__(self, threshold_sec: float = 0.1, interval_sec: float = 0.05, max_stalls: int = 100):
+        self.threshold_sec = threshold_sec
+        self.interval_sec = interval_sec
+        self.stalls = deque(maxlen=max_stalls)
+        self.num_stalls = 0
+        self.max_lag = 0.0  # since the last call to `pop_max_lag`
+
+        self._loop_thread_id = None
+        self._last_beat = time.monotonic()
+        self._current: Optional[dict] = None  # stall in progress
+        self._lock = threading.Lock()
+        self._task = None
+        self._thread = None
+
+    def start(self):
+        """Start watching the running loop."""
+        loop = asyncio.get_running_loop()
+        # asyncio debug mode (PYTHONASYNCIODEBUG=1) also logs each callback slower than the threshold
+        loop.slow_callback_duration = self.threshold_sec
+        self._loop_thread_id = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self._task = asyncio.create_task(self._beat())
+        self._thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._thread.start()
+
+    async def _beat(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval_sec)
+            lag = max(0.0, loop.time() - start - self.interval_sec)
+            telemetry.event_loop_lag.observe(lag)
+            self.max_lag = max(self.max_lag, lag)
+            with self._lock:
+                self._last_beat = time.monotonic()
+                if self._current is not None:
+                    self._current["duration"] = lag
+                    print(f"Event loop stalled for {lag * 1000:.0f} ms in {self._current['location']}")
+                    self._current = None
+
+    def _watch(self):
+        while True:
+            time.sleep(self.interval_sec)
+            with self._lock:
+                blocked_sec = time.monotonic() - self._last_beat - self.interval_sec
+                if self._current is not None or blocked_sec < self.threshold_sec:
+                    continue
+                frame = sys._current_frames().get(self._loop_thread_id)
+                if frame is None:
+                    continue
+                stack = traceback.extract_stack(frame)[-max_stack_depth:]
+                del frame
+                innermost = stack[-1]
+                self._current = {
+                    "time": time.time() - blocked_sec,
+                    "duration": None,  # set when the loop resumes
+                    "location": f"{innermost.filename}:{innermost.lineno} in {innermost.name}",
+                    "stack": "".join(traceback.format_list(stack)),
+                }
+                self.stalls.append(self._current)
+                self.num_stalls += 1
+
+    def pop_max_lag(self) -> float:
+        max_lag, self.max_lag = self.max_lag, 0.0
+        return max_lag
+
+    def get_stalls(self, limit: Optional[int] = None) -> list:
+        """Stalls from the newest to the oldest."""
+        with self._lock:
+            stalls = [dict(stall) for stall in reversed(self.stalls)]
+        return stalls[:limit] if limit is not None else stalls
@@ -1,12 +1,95 @@
+import asyncio
+import os
+import time
+from typing import Optional
+
 import socketio
-from aiortc import RTCConfiguration, RTCPeerConnection, RTCSessionDescription  # , RTCIceServer
+from aiortc import (
+    RTCBundlePolicy,
+    RTCConfiguration,
+    RTCIceServer,
+    RTCPeerConnection,
+    RTCRtpSender,
+    RTCSessionDescription,
+)
 from aiortc.sdp import candidate_from_sdp
 
+from app.utils import telemetry
+
+pool_size = 2  # peer connections kept ready for each stream layout
+
+
+def create_rtc_configuration():
+    # all tracks share one transport, so ICE and DTLS are negotiated once per client
+    config = RTCConfiguration(bundlePolicy=RTCBundlePolicy.MAX_BUNDLE)
+    # e.g. WEBRTC_ICE_SERVERS="" on a LAN to skip the default STUN server, whose queries delay the offer
+    ice_servers = os.getenv("WEBRTC_ICE_SERVERS")
+    if ice_servers is not None:
+        config.iceServers = [RTCIceServer(urls=url) for url in ice_servers.split(",") if url]
+    return config
+
+
+def create_sendonly_peer_connection(num_transceivers: int):
+    # transceivers get their tracks with replaceTrack once the client requests the offer
+    pc = RTCPeerConnection(create_rtc_configuration())
+    for _ in range(num_transceivers):
+        transceiver = pc.addTransceiver("video", direction="sendonly")
+        force_codec(pc, transceiver.sender, "video/H264")  # tracks carry packets encoded once for all clients
+    return pc
+
+
+async def pregather(pc: RTCPeerConnection):
+    # gather the ICE candidates now; setLocalDescription then skips the gathering
+    gatherers = {transceiver.sender.transport.transport.iceGatherer for transceiver in pc.getTransceivers()}
+    await asyncio.gather(*[gatherer.gather() for gatherer in gatherers])
+
 
-def createPeerConnection(sio: socketio.AsyncServer, sid: str):
-    config = RTCConfiguration()
-    # config.iceServers = [RTCIceServer(urls="stun:stun.l.google.com:19302")]
-    pc = RTCPeerConnection(config)
+class PeerConnectionPool:
+    """Keeps peer connections with their transceivers created and candidates gathered ahead of offers."""
+
+    def __init__(self, num_transceivers: int, size: int = pool_size):
+        self.num_transceivers = num_transceivers
+        self.size = size
+        self.ready = []
+        self.tasks = set()
+        self.fill()
+
+    def fill(self):
+        for _ in range(self.size - len(self.ready) - len(self.tasks)):
+            task = asyncio.create_task(self._prepare())
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def _prepare(self):
+        pc = create_sendonly_peer_connection(self.num_transceivers)
+        try:
+            await pregather(pc)
+        except asyncio.CancelledError:
+            await pc.close()  # by close
+            raise
+        self.ready.append(pc)
+
+    def acquire(self) -> RTCPeerConnection:
+        if len(self.ready) > 0:
+            pc = self.ready.pop(0)
+        else:
+            print("No pre-gathered peer connection ready")
+            pc = create_sendonly_peer_connection(self.num_transceivers)
+        self.fill()
+        return pc
+
+    async def close(self):
+        for task in list(self.tasks):
+            task.cancel()
+        for pc in self.ready:
+            await pc.close()
+        self.ready.clear()
+
+
+def createPeerConnection(sio: socketio.AsyncServer, sid: str, pc: Optional[RTCPeerConnection] = None):
+    if pc is None:
+        pc = RTCPeerConnection(create_rtc_configuration())
+    telemetry.webrtc_peers.inc()  # decremented when the server closes it, see _close_peer_connection in app/main.py
 
     @pc.on("icecandidate")
     async def on_icecandidate(candidate):
@@ -41,12 +124,21 @@ def createPeerConnection(sio: socketio.AsyncServer, sid: str):
     return pc
 
 
+def force_codec(pc: RTCPeerConnection, sender: RTCRtpSender, forced_codec: str):
+    # e.g. "video/H264"; required for tracks sending pre-encoded packets
+    kind = forced_codec.split("/")[0]
+    codecs = RTCRtpSender.getCapabilities(kind).codecs
+    transceiver = next(t for t in pc.getTransceivers() if t.sender == sender)
+    transceiver.setCodecPreferences([codec for codec in codecs if codec.mimeType == forced_codec])
+
+
 async def handle_offer_request(pc: RTCPeerConnection, sio: socketio.AsyncServer, sid: str):
     print("/browser: Received offer request")
+    start = time.time()
     offer = await pc.createOffer()
     print("Setting local description...")
-    await pc.setLocalDescription(offer)  # slow; takes 5s
-    print("Local description set.")
+    await pc.setLocalDescription(offer)  # slow unless the candidates were gathered in advance (see pregather)
+    print(f"Local description set in {time.time() - start:.2f} s.")
     await sio.emit("webrtc-offer", {"sdp": offer.sdp}, to=sid)
     print("/browser: Sent WebRTC offer.")
 
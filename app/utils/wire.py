@@ -0,0 +1,65 @@
+"""Packed encoding of the high-rate socket.io events.
+
+With the "msgpack" wire format, `command`, `subtaskDone` and `eeg` are sent as msgpack arrays
+(field values in the order below) instead of JSON objects, and likelihoods as raw float64 bytes.
+Receivers accept both encodings, so JSON clients such as app/scripts/load_test.py keep working.
+Mirrored in app/static/wire.js.
+"""
+
+import msgpack
+import numpy as np
+
+wire_formats = ("json", "msgpack")
+
+# events sent to the browsers
+event_fields = {
+    "command": [
+        "agentId",
+        "command",
+        "nextAcceptableCommands",
+        "isNowAcceptable",
+        "hasSubtaskNotDone",
+        "likelihoods",
+        "interactionTime",
+        "username",
+    ],
+    "subtaskDone": ["agentId", "subtask"],
+    "eeg": ["classId", "likelihoods"],
+}
+# events sent by the browsers; the user is known from the session, so it is not repeated here
+request_fields = {
+    "command": ["agentId", "command", "likelihoods", "interactionTime"],
+}
+float_array_fields = {"likelihoods"}
+
+
+def pack(fields: list, data: dict) -> bytes:
+    values = []
+    for field in fields:
+        value = data.get(field)
+        if field in float_array_fields and value is not None:
+            value = np.asarray(value, dtype="<f8").tobytes()
+        values.append(value)
+    return msgpack.packb(values)
+
+
+def unpack(fields: list, payload: bytes) -> dict:
+    data = dict(zip(fields, msgpack.unpackb(payload)))
+    for field in float_array_fields:
+        if data.get(field) is not None:
+            data[field] = np.frombuffer(data[field], dtype="<f8").tolist()
+    return data
+
+
+def encode_event(event: str, data: dict, wire_format: str):
+    """Payload of an outgoing event in the given wire format."""
+    if wire_format == "msgpack" and event in event_fields:
+        return pack(event_fields[event], data)
+    return data
+
+
+def decode_request(event: str, payload):
+    """Data of an incoming event sent in either wire format."""
+    if isinstance(payload, (bytes, bytearray)):
+        return unpack(request_fields[event], payload)
+    return payload